@@ -0,0 +1,54 @@
+import pandas as pd
+from sqlalchemy import func, literal_column, select, union_all
+
+
+def get_ctes(future, option):
+    # In: the future and option tables (live or staging), Out: CTEs of the cells and of the underlyings
+    instruments = union_all(
+        select([future.c.lasttrademonth, future.c.assetcode, future.c.oi_rub,
+                literal_column("1").label("is_future")]),
+        select([option.c.lasttrademonth, option.c.assetcode, option.c.oi_rub,
+                literal_column("0").label("is_future")])).cte("instruments")
+
+    # a cell has futures if the max of is_future is 1 and options if its min is 0
+    cells = select([instruments.c.assetcode.label("underlying"),
+                    instruments.c.lasttrademonth.label("year_month"),
+                    func.sum(instruments.c.oi_rub).label("oi_rub"),
+                    func.sum(instruments.c.oi_rub * instruments.c.is_future).label("futures_oi_rub"),
+                    func.max(instruments.c.is_future).label("has_futures"),
+                    func.min(instruments.c.is_future).label("no_options")])\
+        .group_by(instruments.c.lasttrademonth, instruments.c.assetcode).cte("cells")
+
+    # underlyings ranked by OI_RUB of their futures, as the rows of the map are ordered
+    futures_oi_rub = func.sum(cells.c.futures_oi_rub)
+    underlyings = select([cells.c.underlying,
+                          futures_oi_rub.label("underlying_oi_rub"),
+                          func.rank().over(order_by=futures_oi_rub.desc()).label("underlying_rank")])\
+        .where(cells.c.has_futures == 1).group_by(cells.c.underlying).cte("underlyings")
+    return cells, underlyings
+
+
+def get_cell_query(future, option):
+    # one statement: OI_RUB of every cell, its F/O flags, the max over all cells for the colors
+    # and the rank of the underlying
+    cells, underlyings = get_ctes(future, option)
+    return select([cells.c.underlying, cells.c.year_month, cells.c.oi_rub, cells.c.has_futures,
+                   (1 - cells.c.no_options).label("has_options"),
+                   func.max(cells.c.oi_rub).over().label("max_oi_rub"),
+                   underlyings.c.underlying_oi_rub, underlyings.c.underlying_rank])\
+        .select_from(cells.outerjoin(underlyings, cells.c.underlying == underlyings.c.underlying))\
+        .order_by(cells.c.year_month, cells.c.underlying)
+
+
+def get_rank_query(future, option):
+    cells, underlyings = get_ctes(future, option)
+    return select([underlyings.c.underlying, underlyings.c.underlying_oi_rub, underlyings.c.underlying_rank])\
+        .order_by(underlyings.c.underlying_rank, underlyings.c.underlying)
+
+
+def get_cells(connection, future, option):
+    return pd.read_sql(get_cell_query(future, option), connection)
+
+
+def get_ranks(connection, future, option):
+    return pd.read_sql(get_rank_query(future, option), connection)
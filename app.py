@@ -1,11 +1,16 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+import fcntl
+import numpy as np
 import os
-import requests
 import pandas as pd
+import tempfile
+import threading
 import time
 
-from sqlalchemy import func
-from flask import Flask, render_template, request, redirect, url_for
+from sqlalchemy import text
+from flask import Flask, Response, jsonify, render_template, request, redirect, stream_with_context, url_for
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from flask_admin import Admin
@@ -14,12 +19,46 @@ from flask_admin.contrib.sqla import ModelView
 
 
 from models import db, Underlying, Cell, Future, Option, FeedBack, AdminUser, Edition
-from functions import get_data, get_table, get_colors, iss_urls, short_number, get_year_month, round_up_log
+import aggregate
+from bulk import upsert_frame, write_frame
+import chain
+from expiry import ExpiryIndex
+import history
+import metrics
+from shadow import Generation, collect_garbage
+from iss import get_client
+from metrics import timed, timer
+from page_cache import PageCache, get_response, get_stream_response
+from snapshot import SnapshotCache
+from functions import get_data, get_cell_index, get_colors, get_colors_vec, get_year_month_vec, round_up_log
 from config import Config
 
 
 app = Flask(__name__)
 
+# how often the background worker polls ISS for a new data edition, seconds
+REFRESH_INTERVAL = int(os.environ.get("REFRESH_INTERVAL", 600))
+# how long an ISS edition answer is reused before asking ISS again, seconds
+EDITION_TTL = int(os.environ.get("EDITION_TTL", 300))
+# "incremental" diffs fresh data against the stored rows, "full" builds new tables and swaps them in
+REFRESH_MODE = os.environ.get("REFRESH_MODE", "incremental")
+# filtered views of the matrix kept per data version
+VIEW_CACHE_SIZE = 64
+# "1" - / is rendered while it is sent instead of being kept in the page cache
+STREAM_INDEX = os.environ.get("STREAM_INDEX", "0") == "1"
+# template events joined into one chunk of a streamed page
+STREAM_BUFFER = 50
+# repeated strings and narrow numbers of the Future / Option / Cell frames: about 2.6 MB of frames
+# per 10k stored futures and options instead of 5 MB, test.py keeps them under MEMORY_BUDGET
+CATEGORY_COLUMNS = ["assetcode", "lasttrademonth", "underlying_future", "underlying", "year_month", "color", "label"]
+COMPACT_TYPES = {"id": "int32", "prevopenposition": "int32", "oi_percentage": "float32"}
+# columns which change for the same instrument between editions
+INSTRUMENT_COLUMNS = ["prevopenposition", "prevsettleprice", "oi_rub", "oi_percentage"]
+# single-flight lock for the update pipeline: pg advisory lock id or a lock file for single host databases
+REFRESH_LOCK_ID = 20200819
+REFRESH_LOCK_FILE = os.environ.get("REFRESH_LOCK_FILE",
+                                   os.path.join(tempfile.gettempdir(), "derivative_map_refresh.lock"))
+
 app.config.from_object(Config)
 db.init_app(app)
 migrate = Migrate(app, db)
@@ -38,67 +77,92 @@ admin.add_view(MyUserView(Cell, db.session))
 admin.add_view(MyUserView(Edition, db.session))
 
 
-def update_futopt_tables(db_future_nrows, db_option_nrows):
-    text_errors = []
-    try:
-        data = get_data()
-    except:
-        df_fut = pd.read_sql(db.session.query(Future).statement, db.session.bind)
-        df_opt = pd.read_sql(db.session.query(Option).statement, db.session.bind)
-    else:
-        if 0.5*db_future_nrows < len(data["futures"]):
-            # clear table with staled data
-            db.session.query(Future).delete()
+def log_bulk_write(stats):
+    app.logger.info("bulk write: {} rows into {} in {:.2f} s ({:.0f} rows/s)"
+                    .format(stats["rows"], stats["table"], stats["seconds"], stats["rows_per_second"]))
 
-            # write fresh data
-            for row in data["futures"].drop_duplicates().iterrows():
-                future = Future(secid=row[1].SECID, shortname=row[1].SHORTNAME, lasttradedate=row[1].LASTTRADEDATE,
-                                assetcode=row[1].ASSETCODE, prevopenposition=row[1].PREVOPENPOSITION,
-                                prevsettleprice=row[1].PREVSETTLEPRICE, oi_rub=row[1].OI_RUB,
-                                oi_percentage=row[1].OI_PERCENTAGE, lasttrademonth=row[1].LASTTRADEMONTH,
-                                date_created=datetime.utcnow())
-                db.session.add(future)
 
-            try:
-                editions = db.session.query(Edition).filter(Edition.table == "futures").first()
-                editions.edition = data["future_edition"]
-                editions.date_created = datetime.utcnow()
-            except AttributeError:
-                editions = Edition(table="futures", edition=data["future_edition"], date_created=datetime.utcnow())
-                db.session.add(editions)
-
-            db.session.commit()
-        else:
-            text_errors.append("a new data of futures has too little rows")
+def log_upsert(stats):
+    app.logger.info("upsert into {}: {} inserted, {} updated, {} deleted, {} unchanged in {:.2f} s"
+                    .format(stats["table"], stats["inserted"], stats["updated"], stats["deleted"],
+                            stats["unchanged"], stats["seconds"]))
 
 
-        if 0.5*db_option_nrows < len(data["options"]):
+def write_table(model, df, keys, compare_columns, generation=None):
+    with timer("write_table", table=model.__tablename__):
+        if generation is not None:
+            # a staging table of the generation, readers keep the live one until publish_generation
+            stats = generation.stage(model, df)
+            log_bulk_write(stats)
+        elif REFRESH_MODE == "incremental":
+            stats = upsert_frame(db.session, model, df, keys, compare_columns)
+            log_upsert(stats)
+        else:
             # clear table with staled data
-            db.session.query(Option).delete()
+            db.session.query(model).delete()
+            stats = write_frame(db.session, model, df)
+            log_bulk_write(stats)
+    metrics.inc("rows_written_total", stats["rows"], table=model.__tablename__)
 
-            # write fresh data
-            for row in data["options"].drop_duplicates().iterrows():
-                option = Option(secid=row[1].SECID, shortname=row[1].SHORTNAME, lasttradedate=row[1].LASTTRADEDATE,
-                                assetcode=row[1].ASSETCODE, prevopenposition=row[1].PREVOPENPOSITION,
-                                prevsettleprice=row[1].PREVSETTLEPRICE, oi_rub=row[1].OI_RUB,
-                                oi_percentage=row[1].OI_PERCENTAGE, lasttrademonth=row[1].LASTTRADEMONTH,
-                                underlying_future=row[1].UNDERLYING, date_created=datetime.utcnow())
-                db.session.add(option)
 
-            try:
-                editions = db.session.query(Edition).filter(Edition.table == "options").first()
-                editions.edition = data["option_edition"]
-                editions.date_created = datetime.utcnow()
-            except AttributeError:
-                editions = Edition(table="options", edition=data["option_edition"], date_created=datetime.utcnow())
-                db.session.add(editions)
-
-            db.session.commit()
-        else:
-            text_errors.append("a new data of options has too little rows")
+def set_edition(table, edition, generation=None):
+    # with a generation the edition is published together with its tables, otherwise with the refresh commit
+    if generation is not None:
+        generation.editions[table] = edition
+        return
 
-        df_fut = pd.read_sql(db.session.query(Future).statement, db.session.bind)
-        df_opt = pd.read_sql(db.session.query(Option).statement, db.session.bind)
+    try:
+        editions = db.session.query(Edition).filter(Edition.table == table).first()
+        editions.edition = edition
+        editions.date_created = datetime.utcnow()
+    except AttributeError:
+        editions = Edition(table=table, edition=edition, date_created=datetime.utcnow())
+        db.session.add(editions)
+
+
+@timed("update_futopt_tables")
+def update_futopt_tables(db_future_nrows, db_option_nrows, generation=None):
+    text_errors = []
+    # a failed download ends the refresh: nothing is written and the previous data stays published
+    with timer("get_data"):
+        data = get_data()
+    metrics.inc("iss_rows_total", len(data["futures"]), market="futures")
+    metrics.inc("iss_rows_total", len(data["options"]), market="options")
+
+    if 0.5*db_future_nrows < len(data["futures"]):
+        # write fresh data
+        df_new = data["futures"].drop_duplicates().rename(columns=str.lower)
+        write_table(Future, df_new, ["secid"], INSTRUMENT_COLUMNS, generation)
+        set_edition("futures", data["future_edition"], generation)
+    else:
+        text_errors.append("a new data of futures has too little rows")
+
+
+    if 0.5*db_option_nrows < len(data["options"]):
+        # write fresh data
+        df_new = data["options"].drop_duplicates().rename(columns=str.lower)\
+            .rename(columns={"underlying": "underlying_future"})
+        write_table(Option, df_new, ["secid"], INSTRUMENT_COLUMNS, generation)
+        set_edition("options", data["option_edition"], generation)
+
+        # strike level options of this edition for /api/chain
+        try:
+            with timer("chain_save"):
+                chain.save(data)
+        except (OSError, ValueError):
+            app.logger.exception("chain: the strikes are not stored")
+    else:
+        text_errors.append("a new data of options has too little rows")
+
+    # every edition is kept in the append-only history store
+    try:
+        with timer("history_append"):
+            history.append(data)
+    except (OSError, ValueError):
+        app.logger.exception("history: the edition is not stored")
+
+    df_fut = read_table(Future, generation)
+    df_opt = read_table(Option, generation)
     return [df_fut, df_opt]
 
 
@@ -116,38 +180,37 @@ def update_underlying(df_fut):
                                   date_created=datetime.utcnow())
             db.session.add(db_undrl)
 
-        db.session.commit()
+        db.session.flush()
 
-    df_undrl = pd.read_sql(db.session.query(Underlying).statement, db.session.bind).set_index('underlying')
+    df_undrl = pd.read_sql(db.session.query(Underlying).statement, db.session.connection()).set_index('underlying')
 
     return df_undrl
 
 
-def update_matrix(df_fut, df_opt, df_undrl):
-    # combining tables fut and opt
-    df_fut['type'] = 'F'
-    df_opt['type'] = 'O'
-    df_futopt_grouped = pd.concat([df_fut, df_opt]).groupby(["lasttrademonth", "assetcode"])
+def get_next_publication():
+    published = db.session.query(Edition.edition).filter(Edition.table == "published").scalar()
+    return (published or 0) + 1
 
-    # cell - max OI_RUB for coloring the cell
-    cell_max_OI_rub = df_futopt_grouped['oi_rub'].sum().max()
-    d_colors = get_colors()
-    n_colors = len(d_colors)
 
-    # cleaning cells table
-    db.session.query(Cell).delete()
+@timed("update_matrix")
+def update_matrix(generation=None):
+    # OI_RUB sums, F/O flags and the max for coloring come from one statement of the database,
+    # only the cells, not the instruments, are read into pandas
+    future, option = [generation.get_table(model) if generation is not None else model.__table__
+                      for model in [Future, Option]]
+    df_cells = aggregate.get_cells(db.session.connection(), future, option)
 
     # filling cells
-    for name, group in df_futopt_grouped:
-        cell_OI_rub = group['oi_rub'].sum()
-        cell_type = set(group['type'].unique())
-        db_cell = Cell(underlying=name[1], year_month=name[0],
-                       color=d_colors[round_up_log(cell_OI_rub, cell_max_OI_rub, n_colors)],
-                       label=" ".join(sorted([e for e in cell_type])),
-                       date_created=datetime.utcnow())
-        db.session.add(db_cell)
-
-    db.session.commit()
+    df_cells["color"] = get_colors_vec(df_cells['oi_rub'], df_cells['max_oi_rub'].max())
+    is_fut = df_cells["has_futures"] == 1
+    is_opt = df_cells["has_options"] == 1
+    df_cells["label"] = np.select([is_fut & is_opt, is_fut], ["F O", "F"], "O")
+
+    # only cells whose color or label changed are written in the incremental mode
+    write_table(Cell, df_cells[["underlying", "year_month", "color", "label"]], ["underlying", "year_month"],
+                ["color", "label"], generation)
+    # the last step of a refresh: the marker goes out together with the cells and keys the snapshots
+    set_edition("published", get_next_publication(), generation)
     return 'd'
 
 
@@ -169,6 +232,8 @@ def update_matrix_reserved(df_fut, df_opt, df_undrl):
 
     # getting columns
     dates_lst = set(df_fut["lasttrademonth"]).union(set(df_opt["lasttrademonth"]))
+    cell_index = get_cell_index(df_fut, df_opt, ["assetcode", "lasttrademonth"], columns_fut, columns_opt)
+    empty_cell = {"futures": [], "options": []}
 
     # cleaning cells table
     db.session.query(Cell).delete()
@@ -180,16 +245,16 @@ def update_matrix_reserved(df_fut, df_opt, df_undrl):
             cell_OI = 0
             cell_type = set()
             cell_OI_rub = 0
+            instruments = cell_index.get((row, col), empty_cell)
 
-
-            for i in df_fut[(df_fut["assetcode"] == row) & (df_fut["lasttrademonth"] == col)][columns_fut].values:
-                cell_OI += i[3]
-                cell_OI_rub += i[4]
+            for i in instruments["futures"]:
+                cell_OI += i["prevopenposition"]
+                cell_OI_rub += i["oi_rub"]
                 cell_type.add("F")
 
-            for i in df_opt[(df_opt["assetcode"] == row) & (df_opt["lasttrademonth"] == col)][columns_opt].values:
-                cell_OI += i[3]
-                cell_OI_rub += i[4]
+            for i in instruments["options"]:
+                cell_OI += i["prevopenposition"]
+                cell_OI_rub += i["oi_rub"]
                 cell_type.add("O")
 
             if len(cell_type) > 0:
@@ -215,6 +280,7 @@ def update_matrix_reserved(df_fut, df_opt, df_undrl):
     return 'd'
 
 
+@timed("get_dictionary")
 def get_dictionary(df_cell, df_fut, df_opt):
 
     # getting columns and rows
@@ -236,10 +302,13 @@ def get_dictionary(df_cell, df_fut, df_opt):
                                 "options": []}
 
     dict_cell = df_cell.set_index(['underlying', 'year_month']).to_dict(orient='index')
+    cell_index = get_cell_index(df_fut, df_opt, ["assetcode", "lasttrademonth"], columns_fut, columns_opt)
+    empty_cell = {"futures": [], "options": []}
 
     for key, value in dict_cell.items():
-        lst_fut = df_fut[(df_fut["assetcode"] == key[0]) & (df_fut["lasttrademonth"] == key[1])][columns_fut].to_dict(orient='records')
-        lst_opt = df_opt[(df_opt["assetcode"] == key[0]) & (df_opt["lasttrademonth"] == key[1])][columns_opt].to_dict(orient='records')
+        instruments = cell_index.get(key, empty_cell)
+        lst_fut = instruments["futures"]
+        lst_opt = instruments["options"]
 
         d[key[0]][key[1]] = {
                 "cell_name": "{}{}".format(key[0], key[1].replace(" ", "")),
@@ -249,55 +318,144 @@ def get_dictionary(df_cell, df_fut, df_opt):
     return d
 
 
-@app.route("/", methods=["GET"])
-def index():
-    df_fut = pd.DataFrame()
-    df_opt = pd.DataFrame()
-    df_undrl = pd.DataFrame()
+iss_editions_cache = {"editions": None, "checked_at": 0.0}
 
-    # db.session.query(Future).delete()
-    # db.session.query(Cell).delete()
+
+def get_iss_editions(ttl=EDITION_TTL):
+    if iss_editions_cache["editions"] and time.time() - iss_editions_cache["checked_at"] < ttl:
+        metrics.inc("edition_checks_total", source="cache")
+        return iss_editions_cache["editions"]
+
+    metrics.inc("edition_checks_total", source="iss")
+    with timer("edition_check"):
+        iss_editions = get_client().get_all_editions()
+    iss_editions_cache["editions"] = [iss_editions["futures"], iss_editions["options"]]
+    iss_editions_cache["checked_at"] = time.time()
+    return iss_editions_cache["editions"]
+
+
+def get_db_editions():
+    try:
+        db_future_edition = db.session.query(Edition).filter(Edition.table == "futures").first().edition
+        db_option_edition = db.session.query(Edition).filter(Edition.table == "options").first().edition
+    except AttributeError:
+        return [None, None]
+    return [db_future_edition, db_option_edition]
+
+
+@contextmanager
+def refresh_lock():
+    # yields True only in the one process which is allowed to run the update pipeline, it never waits
+    if db.engine.dialect.name == "postgresql":
+        with db.engine.connect() as conn:
+            acquired = conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": REFRESH_LOCK_ID}).scalar()
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": REFRESH_LOCK_ID})
+    else:
+        with open(REFRESH_LOCK_FILE, "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+            except BlockingIOError:
+                acquired = False
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def is_data_stale():
     # грубо проверяем что в БД консистентные данные. проверка по кол-ву записей (50 записей для фьючей)
     db_future_nrows = db.session.query(Future).count()
     db_option_nrows = db.session.query(Option).count()
     if db_future_nrows < 100 or db_option_nrows < 50:
-        df_fut, df_opt = update_futopt_tables(db_future_nrows, db_option_nrows)
-        df_undrl = update_underlying(df_fut)
-        dict_cell = update_matrix(df_fut, df_opt, df_undrl)
-
-    # во-вторых проверяем совпадение даты сегодня и даты обновления таблицы
-    try:
-        db_future_date = db.session.query(func.max(Future.date_created)).first()[0].strftime("%Y-%m-%d")
-        db_option_date = db.session.query(func.max(Option.date_created)).first()[0].strftime("%Y-%m-%d")
-    except AttributeError:
-        db_future_date = "1999-09-19"
-        db_option_date = "1999-09-19"
-    current_date = datetime.utcnow().strftime("%Y-%m-%d")
+        return True
 
-    if db_future_date != current_date or db_option_date != current_date:
-        # далее проверяем версионность данных - в выходные даты могут не совпадать, но в источнике также не обновл
-        db_future_edition = db.session.query(Edition).filter(Edition.table == "futures").first().edition
-        db_option_edition = db.session.query(Edition).filter(Edition.table == "options").first().edition
-        iss_future_edition = requests.get(iss_urls()["query_futures_edition"]).json()["dataversion"]["data"][0][0]
-        iss_option_edition = requests.get(iss_urls()["query_options_edition"]).json()["dataversion"]["data"][0][0]
-        if db_future_edition != iss_future_edition or db_option_edition != iss_option_edition:
-            df_fut, df_opt = update_futopt_tables(db_future_nrows, db_option_nrows)
-            df_undrl = update_underlying(df_fut)
-            dict_cell = update_matrix(df_fut, df_opt, df_undrl)
+    # далее проверяем версионность данных - в выходные даты могут не совпадать, но в источнике также не обновл
+    return get_db_editions() != get_iss_editions()
 
 
-    if df_fut.empty:
-        df_fut = pd.read_sql(db.session.query(Future).statement, db.session.bind)
-    if df_opt.empty:
-        df_opt = pd.read_sql(db.session.query(Option).statement, db.session.bind)
-    if df_undrl.empty:
-        df_undrl = pd.read_sql(db.session.query(Underlying).statement, db.session.bind).set_index('underlying')
+def publish_generation(generation):
+    # the row count check of every staged table, then one transaction swaps the tables and the editions
+    invalid = generation.validate()
+    if invalid:
+        app.logger.error("refresh: too few rows in %s, the generation %s is not published",
+                         ", ".join(model.__tablename__ for model in invalid), generation.id)
+        generation.discard()
+    else:
+        def set_editions():
+            for table, edition in generation.editions.items():
+                set_edition(table, edition)
+
+        with timer("publish"):
+            generation.publish(set_editions)
+    collect_garbage(db.engine, [Future, Option, Cell], generation.id)
+    return not invalid
+
+
+def refresh_data():
+    if not is_data_stale():
+        metrics.inc("refreshes_total", result="up_to_date")
+        return False
+
+    with refresh_lock() as acquired:
+        # another worker is rebuilding the tables, this one keeps serving the previous data
+        if not acquired:
+            metrics.inc("refreshes_total", result="locked")
+            return False
+
+        # the lock holder before us could have already published the same edition
+        db.session.rollback()
+        if not is_data_stale():
+            metrics.inc("refreshes_total", result="up_to_date")
+            return False
+
+        # the full mode builds a new generation of the tables aside, the incremental one changes the live tables
+        # in one transaction; either way readers see the previous data until the whole refresh is committed
+        generation = Generation(db.session, [Future, Option, Cell]) if REFRESH_MODE == "full" else None
+        df_fut, df_opt = update_futopt_tables(db.session.query(Future).count(), db.session.query(Option).count(),
+                                              generation)
+        update_underlying(df_fut)
+        update_matrix(generation)
+        if generation is None:
+            with timer("publish"):
+                db.session.commit()
+        elif not publish_generation(generation):
+            metrics.inc("refreshes_total", result="rejected")
+            return False
+
+    # the stored editions came from a fresher ISS answer than the cached one
+    iss_editions_cache["checked_at"] = 0.0
+    metrics.inc("refreshes_total", result="published")
+    return True
+
+
+def refresh_worker(interval):
+    while True:
+        with app.app_context():
+            try:
+                if refresh_data():
+                    app.logger.info("refresh worker: a new data edition is published")
+            except Exception:
+                metrics.inc("refreshes_total", result="failed")
+                app.logger.exception("refresh worker: update failed, keeping the previous data")
+            finally:
+                db.session.remove()
+        time.sleep(interval)
 
-    df_cell = pd.read_sql(db.session.query(Cell).statement, db.session.bind)
 
+def start_refresh_worker():
+    worker = threading.Thread(target=refresh_worker, args=(REFRESH_INTERVAL,), name="refresh-worker", daemon=True)
+    worker.start()
+    return worker
 
-    dict_undrl = df_undrl.to_dict(orient='index')
 
+def get_sections(df_undrl, df_rank):
+    # In: underlyings and their ranks by futures OI_RUB, Out: {section: [underlyings in the rank order], ...}
     dict_section = df_undrl[['section', 'section_id']] \
         .sort_values(by=['section_id']).to_dict()['section']
     dict_section_converted = {}
@@ -305,30 +463,421 @@ def index():
     for value in dict_section.values():
         dict_section_converted[value] = []
 
-    index = df_fut[['assetcode', 'oi_rub']].groupby('assetcode').sum()\
-            .sort_values('oi_rub', ascending=False).index
+    index = df_rank.sort_values(['underlying_rank', 'underlying'])['underlying']
 
     for undrl in index:
+        if undrl not in dict_section:
+            continue
         if dict_section[undrl] in dict_section_converted:
             dict_section_converted[dict_section[undrl]].append(undrl)
         else:
             dict_section_converted[dict_section[undrl]] = [undrl]
+    return dict_section_converted
+
+
+def get_months(df_fut):
+    return list(get_year_month_vec(pd.period_range(start=df_fut["lasttradedate"].min(),
+                                                   end=df_fut["lasttradedate"].max(),
+                                                   freq='M')))
+
+
+def get_cell_matrix(df_cell):
+    # colors and labels only, In: d["Si"]["2020 Sep"] Out: {"color": "#868e96", "label": "F O"}
+    d = {}
+    for row in df_cell[['underlying', 'year_month', 'color', 'label']].itertuples(index=False):
+        d.setdefault(row.underlying, {})[row.year_month] = {"color": row.color, "label": row.label}
+    return d
+
+
+def get_last_modified(df_edition):
+    last_modified = pd.to_datetime(df_edition['date_created']).max()
+    return last_modified.to_pydatetime() if not pd.isnull(last_modified) else None
+
+
+def get_data_version():
+    # the only query of a request served from the snapshot. the "published" marker is committed with the cells,
+    # the last writes of a refresh, so a snapshot read in the middle of a refresh keeps the previous version
+    published = db.session.query(Edition.edition).filter(Edition.table == "published").scalar()
+    return "published:{}".format(published)
+
+
+def compact_frame(df):
+    # repeated strings become categories, numbers get the narrowest type holding them
+    dtypes = {column: "category" for column in CATEGORY_COLUMNS if column in df}
+    dtypes.update({column: dtype for column, dtype in COMPACT_TYPES.items() if column in df})
+    return df.astype(dtypes)
+
+
+def read_table(model, generation=None):
+    # through the connection of the session: a refresh reads its own uncommitted rows
+    if generation is not None:
+        return compact_frame(generation.read(model))
+    return compact_frame(pd.read_sql(db.session.query(model).statement, db.session.connection()))
+
 
-    dict_matrix = get_dictionary(df_cell, df_fut, df_opt)
+@timed("read_frames")
+def read_frames():
+    connection = db.session.connection()
+    return {"futures": read_table(Future),
+            "options": read_table(Option),
+            "underlyings": pd.read_sql(db.session.query(Underlying).statement, connection),
+            "cells": read_table(Cell),
+            "ranks": aggregate.get_ranks(connection, Future.__table__, Option.__table__),
+            "editions": pd.read_sql(db.session.query(Edition).statement, connection)}
 
-    lst_months = []
-    for dt in pd.period_range(start=df_fut["lasttradedate"].min(),
-                              end=df_fut["lasttradedate"].max(),
-                              freq='M'):
-        lst_months.append(get_year_month(dt))
 
-    return render_template("table.html",
+def get_chain_index(df_edition):
+    editions = df_edition.loc[df_edition['table'] == "options", 'edition']
+    return chain.load(editions.iloc[0]) if not editions.empty else None
+
+
+@timed("build_snapshot")
+def build_snapshot(frames):
+    metrics.inc("snapshot_builds_total")
+    df_fut = frames["futures"]
+    df_opt = frames["options"]
+    df_undrl = frames["underlyings"].set_index('underlying')
+    df_cell = frames["cells"]
+    if df_fut.empty:
+        return {"empty": True}
+
+    return {"empty": False,
+            "frames": frames,
+            "dict_section": get_sections(df_undrl, frames["ranks"]),
+            "dict_undrl": df_undrl.to_dict(orient='index'),
+            "lst_months": get_months(df_fut),
+            "dict_matrix": get_dictionary(df_cell, df_fut, df_opt),
+            "dict_cells": get_cell_matrix(df_cell),
+            "expiry_index": ExpiryIndex(df_fut, df_opt, df_undrl),
+            "chain_index": get_chain_index(frames["editions"]),
+            "views": OrderedDict(),
+            "last_modified": get_last_modified(frames["editions"])}
+
+
+snapshot_cache = SnapshotCache(build_snapshot)
+
+
+page_cache = PageCache(max_pages=VIEW_CACHE_SIZE)
+
+
+def get_snapshot(route=None):
+    # route - an API route, its requests are counted as served from the current snapshot or waiting for a build
+    version = get_data_version()
+    if route is not None:
+        metrics.inc("api_requests_total", route=route,
+                    snapshot="hit" if snapshot_cache.version == version else "build")
+    return snapshot_cache.get(version, read_frames)
+
+
+def get_filters(args):
+    # In: ?section=Валюта&underlying=Si,Eu&start=2020-09&end=2021-03&min_oi=1e9, Out: only the given filters,
+    # ValueError on a bad value
+    filters = {}
+    if args.get("section"):
+        filters["section"] = args["section"]
+    if args.get("underlying"):
+        filters["underlyings"] = sorted(set(u for u in args["underlying"].split(",") if u))
+    for key in ["start", "end"]:
+        if args.get(key):
+            filters[key] = pd.Period(datetime.strptime(args[key], "%Y-%m"), freq='M')
+    if args.get("min_oi"):
+        filters["min_oi"] = float(args["min_oi"])
+    return filters
+
+
+def get_filter_key(filters):
+    return "&".join("{}={}".format(key, ",".join(value) if isinstance(value, list) else value)
+                    for key, value in sorted(filters.items()))
+
+
+def build_view(snapshot, filters):
+    # the frames are cut before get_dictionary, so only the matching rows and months are built
+    frames = snapshot["frames"]
+    df_undrl = frames["underlyings"].set_index('underlying')
+    df_fut = frames["futures"]
+    df_opt = frames["options"]
+    df_cell = frames["cells"]
+
+    if "section" in filters:
+        df_undrl = df_undrl[df_undrl["section"] == filters["section"]]
+    if "underlyings" in filters:
+        df_undrl = df_undrl[df_undrl.index.isin(filters["underlyings"])]
+
+    lst_months = snapshot["lst_months"]
+    if "start" in filters or "end" in filters:
+        periods = pd.period_range(start=filters.get("start", df_fut["lasttradedate"].min()),
+                                  end=filters.get("end", df_fut["lasttradedate"].max()), freq='M')
+        months = set(get_year_month_vec(periods))
+        lst_months = [month for month in lst_months if month in months]
+    df_cell = df_cell[df_cell["underlying"].isin(df_undrl.index) & df_cell["year_month"].isin(lst_months)]
+
+    if "min_oi" in filters:
+        # cells whose futures and options together hold less than min_oi roubles are left empty
+        keys = ["assetcode", "lasttrademonth"]
+        df_oi = df_fut.groupby(keys, observed=True)["oi_rub"].sum()\
+            .add(df_opt.groupby(keys, observed=True)["oi_rub"].sum(), fill_value=0)
+        df_oi = df_oi[df_oi >= filters["min_oi"]].reset_index()
+        df_cell = df_cell.merge(df_oi[["assetcode", "lasttrademonth"]],
+                                left_on=["underlying", "year_month"], right_on=["assetcode", "lasttrademonth"])\
+            .drop(columns=["assetcode", "lasttrademonth"])
+
+    df_undrl = df_undrl[df_undrl.index.isin(df_cell["underlying"])]
+    df_fut = df_fut[df_fut["assetcode"].isin(df_undrl.index) & df_fut["lasttrademonth"].isin(lst_months)]
+    df_opt = df_opt[df_opt["assetcode"].isin(df_undrl.index) & df_opt["lasttrademonth"].isin(lst_months)]
+
+    return {"dict_section": get_sections(df_undrl, frames["ranks"]),
+            "dict_undrl": snapshot["dict_undrl"],
+            "lst_months": lst_months,
+            "dict_matrix": get_dictionary(df_cell, df_fut, df_opt),
+            "dict_cells": get_cell_matrix(df_cell),
+            "last_modified": snapshot["last_modified"]}
+
+
+view_lock = threading.Lock()
+
+
+def get_view(snapshot, filters):
+    # no filters - the whole snapshot, otherwise the view of these filters under the current data version
+    if not filters:
+        return snapshot
+    key = get_filter_key(filters)
+    views = snapshot["views"]
+    with view_lock:
+        if key in views:
+            views.move_to_end(key)
+            return views[key]
+
+    metrics.inc("view_builds_total")
+    with timer("build_view"):
+        view = build_view(snapshot, filters)
+    with view_lock:
+        views[key] = view
+        while len(views) > VIEW_CACHE_SIZE:
+            views.popitem(last=False)
+    return view
+
+
+def get_time_upd(snapshot):
+    return snapshot["last_modified"].strftime("%Y-%m-%d") if snapshot["last_modified"] else ""
+
+
+def get_expiry_report(date=None, underlyings=None):
+    # "last trading day today" messages from the stored data, nothing is fetched from ISS
+    snapshot = get_snapshot()
+    if snapshot["empty"]:
+        return []
+    return snapshot["expiry_index"].get_report(date or datetime.now().date(), underlyings)
+
+
+def get_cached_page(name, render):
+    # the rendered page is the same for everybody asking the same filters until the next data version
+    try:
+        filters = get_filters(request.args)
+    except ValueError:
+        return "Фильтры: section, underlying=Si,Eu, start=2020-09, end=2021-03, min_oi=1000000", 400
+    snapshot = get_snapshot()
+    if snapshot["empty"]:
+        return "Данные обновляются, попробуйте зайти через пару минут", 503
+
+    rendered = []
+
+    def render_page():
+        rendered.append(page_name)
+        metrics.inc("page_requests_total", page=name, cache="miss")
+        with timer("render", page=name):
+            return render(get_view(snapshot, filters))
+
+    page_name = "{}?{}".format(name, get_filter_key(filters)) if filters else name
+    page = page_cache.get(snapshot["version"], page_name, render_page, snapshot["last_modified"])
+    if not rendered:
+        metrics.inc("page_requests_total", page=name, cache="hit")
+    response = get_response(page, request)
+    metrics.inc("page_responses_total", page=name, status=response.status_code)
+    return response
+
+
+def get_streamed_page(name, template, get_context):
+    # the header and the legend go out at once, then table rows as the template produces them;
+    # nothing but the current chunk of the page is held in memory
+    try:
+        filters = get_filters(request.args)
+    except ValueError:
+        return "Фильтры: section, underlying=Si,Eu, start=2020-09, end=2021-03, min_oi=1000000", 400
+    snapshot = get_snapshot()
+    if snapshot["empty"]:
+        return "Данные обновляются, попробуйте зайти через пару минут", 503
+
+    def generate_page():
+        metrics.inc("page_requests_total", page=name, cache="stream")
+        context = get_context(get_view(snapshot, filters))
+        app.update_template_context(context)
+        stream = app.jinja_env.get_template(template).stream(context)
+        stream.enable_buffering(STREAM_BUFFER)
+        with timer("render", page=name):
+            for chunk in stream:
+                yield chunk
+
+    response = get_stream_response(stream_with_context(generate_page()), "|".join([snapshot["version"], name,
+                                   get_filter_key(filters)]), snapshot["last_modified"], request)
+    metrics.inc("page_responses_total", page=name, status=response.status_code)
+    return response
+
+
+def iter_rows(view):
+    # In: the snapshot or a filtered view, Out: a section header, then rows of its underlyings, one at a time
+    lst_months = view["lst_months"]
+    for section, lst_undrl in view["dict_section"].items():
+        if not lst_undrl:
+            continue
+        yield {"section": section}
+        for key_undrl in lst_undrl:
+            dict_row = view["dict_matrix"].get(key_undrl, {})
+            yield {"underlying": key_undrl,
+                   "name": view["dict_undrl"].get(key_undrl, {}).get("name", ""),
+                   "cells": [(key_month, dict_row.get(key_month, {})) for key_month in lst_months]}
+
+
+def get_index_context(snapshot):
+    return {"colors": get_colors(),
+            "lst_months": snapshot["lst_months"],
+            "rows": iter_rows(snapshot),
+            "time_upd": get_time_upd(snapshot)}
+
+
+def render_index(snapshot):
+    return render_template("table.html", **get_index_context(snapshot))
+
+
+def render_index_lazy(snapshot):
+    return render_template("table_lazy.html",
                            colors=get_colors(),
-                           dict_section=dict_section_converted,
-                           dict_undrl=dict_undrl,
-                           lst_months=lst_months,
-                           dict_matrix=dict_matrix,
-                           time_upd=current_date)
+                           dict_section=snapshot["dict_section"],
+                           dict_undrl=snapshot["dict_undrl"],
+                           lst_months=snapshot["lst_months"],
+                           dict_cells=snapshot["dict_cells"],
+                           time_upd=get_time_upd(snapshot))
+
+
+@app.route("/", methods=["GET"])
+def index():
+    # the page only reads published data, ISS polling and table rebuilds are done by refresh_worker;
+    # ?section=&underlying=&start=&end=&min_oi= narrow it down to the matching rows and months
+    if STREAM_INDEX or request.args.get("stream") == "1":
+        return get_streamed_page("index", "table.html", get_index_context)
+    return get_cached_page("index", render_index)
+
+
+@app.route("/lazy", methods=["GET"])
+def index_lazy():
+    # the same map, but contracts of a cell are loaded from /api/cell when the cell is clicked
+    return get_cached_page("index_lazy", render_index_lazy)
+
+
+@app.route("/api/matrix", methods=["GET"])
+def api_matrix():
+    snapshot = get_snapshot("matrix")
+    if snapshot["empty"]:
+        return jsonify({"error": "data is being updated"}), 503
+
+    try:
+        view = get_view(snapshot, get_filters(request.args))
+    except ValueError:
+        return jsonify({"error": "filters are section, underlying=Si,Eu, start=2020-09, end=2021-03, min_oi"}), 400
+
+    return jsonify({"sections": view["dict_section"],
+                    "months": view["lst_months"],
+                    "cells": view["dict_cells"],
+                    "time_upd": get_time_upd(snapshot)})
+
+
+@app.route("/api/cell/<underlying>/<year_month>", methods=["GET"])
+def api_cell(underlying, year_month):
+    snapshot = get_snapshot("cell")
+    cell = {} if snapshot["empty"] else snapshot["dict_matrix"].get(underlying, {}).get(year_month, {})
+    if not cell.get("cell_name"):
+        return jsonify({"error": "no instruments for {} {}".format(underlying, year_month)}), 404
+
+    def get_contracts(lst):
+        return [dict(contract, lasttradedate=contract["lasttradedate"].strftime("%d-%m-%Y")) for contract in lst]
+
+    return jsonify({"cell_name": cell["cell_name"],
+                    "futures": get_contracts(cell["futures"]),
+                    "options": get_contracts(cell["options"])})
+
+
+@app.route("/api/chain/<series>", methods=["GET"])
+def api_chain(series):
+    # OI by strike of calls and puts of an option series, e.g. /api/chain/Si-9.20M170920
+    if not chain.is_enabled():
+        return jsonify({"error": "the option chain store is not available"}), 501
+    snapshot = get_snapshot("chain")
+    if snapshot["empty"] or snapshot["chain_index"] is None:
+        return jsonify({"error": "data is being updated"}), 503
+
+    with timer("chain_query"):
+        d = snapshot["chain_index"].get_chain(series)
+    if d is None:
+        return jsonify({"error": "no options of the series {}".format(series)}), 404
+    return jsonify(dict(d, lasttradedate=d["lasttradedate"].strftime("%d-%m-%Y")))
+
+
+@app.route("/api/history", methods=["GET"])
+def api_history():
+    # OI time series of an underlying, of an expiry month or of a cell (both),
+    # e.g. /api/history?underlying=Si&start=2020-07-01&end=2020-09-30
+    underlying = request.args.get("underlying")
+    year_month = request.args.get("year_month")
+    if not history.is_enabled():
+        return jsonify({"error": "the history store is not available"}), 501
+    if not underlying and not year_month:
+        return jsonify({"error": "underlying or year_month is required"}), 400
+    try:
+        start = datetime.strptime(request.args["start"], "%Y-%m-%d") if request.args.get("start") else None
+        end = datetime.strptime(request.args["end"], "%Y-%m-%d") if request.args.get("end") else None
+    except ValueError:
+        return jsonify({"error": "start and end are dates like 2020-09-30"}), 400
+
+    with timer("history_query"):
+        df = history.query(underlying, year_month, start, end, request.args.get("type"))
+    return jsonify({"underlying": underlying,
+                    "year_month": year_month,
+                    "series": df.to_dict(orient='records')})
+
+
+@app.route("/api/expiries", methods=["GET"])
+def api_expiries():
+    # instruments with the last trading day on a date or in a range, e.g.
+    # /api/expiries?date=2020-09-17 or /api/expiries?start=2020-09-01&end=2020-09-30&section=Валюта&underlying=Si,Eu
+    snapshot = get_snapshot("expiries")
+    if snapshot["empty"]:
+        return jsonify({"error": "data is being updated"}), 503
+    try:
+        start = datetime.strptime(request.args.get("date") or request.args["start"], "%Y-%m-%d")
+        end = datetime.strptime(request.args["end"], "%Y-%m-%d") if request.args.get("end") else None
+    except (KeyError, ValueError):
+        return jsonify({"error": "date or start (and end) are required, dates like 2020-09-30"}), 400
+
+    underlyings = [u for u in request.args.get("underlying", "").split(",") if u]
+    df = snapshot["expiry_index"].get_range(start, end, request.args.get("section"), underlyings)
+
+    def get_contracts(df_type):
+        return [dict(contract, lasttradedate=contract["lasttradedate"].strftime("%d-%m-%Y"))
+                for contract in df_type.to_dict(orient='records')]
+
+    columns = ["secid", "shortname", "assetcode", "section", "lasttradedate", "prevopenposition", "oi_rub"]
+    return jsonify({"start": start.strftime("%Y-%m-%d"),
+                    "end": (end or start).strftime("%Y-%m-%d"),
+                    "futures": get_contracts(df[df["type"] == "F"][columns]),
+                    "options": get_contracts(df[df["type"] == "O"][columns + ["underlying_future"]])})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+metrics.start_profiler()
 
 if __name__ == "__main__":
+    start_refresh_worker()
     app.run()
@@ -0,0 +1,292 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+import iss
+from functions import get_cell_index, get_data, get_table
+
+
+COLUMNS_ISS = ["SECID", "SHORTNAME", "LASTTRADEDATE", "ASSETCODE", "PREVOPENPOSITION", "PREVSETTLEPRICE",
+               "MINSTEP", "STEPPRICE"]
+SECTIONS = ["Валюта", "Индексы", "Акции", "Товары", "Процентные ставки"]
+RESULTS_FILE = os.environ.get("BENCH_RESULTS", "bench_results.jsonl")
+
+
+def make_iss_payload(underlyings=1, futures=1, strikes=1, seed=0):
+    # synthetic answers of the ISS securities endpoints, multipliers 1/1/1 are roughly the FORTS universe:
+    # 60 underlyings with 6 futures each, options on the nearest 4 futures with 20 strikes of calls and puts
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range("2020-09-01", periods=6 * futures, freq="MS") + pd.Timedelta(days=16)
+
+    rows_fut = []
+    rows_opt = []
+    for u in range(60 * underlyings):
+        assetcode = "U{}".format(u)
+        price = rng.uniform(10, 100000)
+        for m, date in enumerate(dates):
+            shortname = "{}-{}.{}".format(assetcode, date.month, date.strftime("%y"))
+            secid = "{}{}{}".format(assetcode, m, date.strftime("%y"))
+            rows_fut.append([secid, shortname, date.strftime("%Y-%m-%d"), assetcode, float(rng.randint(0, 100000)),
+                             price * rng.uniform(0.9, 1.1), 1.0, 1.0])
+            if m >= 4:
+                continue
+            for s in range(20 * strikes):
+                strike = round(price * (0.5 + s / (20.0 * strikes)), 0)
+                for option_type in "CP":
+                    rows_opt.append(["{}{}{}".format(secid, option_type, s),
+                                     "{}M{}{}A{:g}".format(shortname, date.strftime("%d%m%y"), option_type, strike),
+                                     date.strftime("%Y-%m-%d"), assetcode, float(rng.randint(0, 5000)),
+                                     rng.uniform(1, price / 10), 1.0, 1.0])
+    return {"futures": rows_fut, "options": rows_opt}
+
+
+class PayloadClient:
+    # an IssClient answering from a synthetic payload without any HTTP
+    def __init__(self, payload):
+        self.payload = payload
+
+    def get_all_securities(self, columns, paginate=False):
+        return {market: {"frame": pd.DataFrame(rows, columns=COLUMNS_ISS)[columns], "edition": 1}
+                for market, rows in self.payload.items()}
+
+    def get_all_editions(self):
+        return {market: 1 for market in self.payload}
+
+
+def start_iss_server(payload, edition=1, page_size=None, cursor=True, ignore_start=False):
+    # a local stand-in of iss.moex.com serving the payload, Out: (server, base url);
+    # page_size - pages of start=, with the securities.cursor block if cursor, ignore_start - a broken endpoint
+    bodies = {market: json.dumps({"securities": {"columns": COLUMNS_ISS, "data": rows},
+                                  "dataversion": {"columns": ["data_version", "seqnum"], "data": [[edition, 1]]}})
+              .encode() for market, rows in payload.items()}
+
+    def get_page(market, start):
+        rows = payload[market]
+        start = 0 if ignore_start else start
+        page = {"securities": {"columns": COLUMNS_ISS, "data": rows[start:start + page_size]},
+                "dataversion": {"columns": ["data_version", "seqnum"], "data": [[edition, 1]]}}
+        if cursor:
+            page["securities.cursor"] = {"columns": ["INDEX", "TOTAL", "PAGESIZE"],
+                                         "data": [[start, len(rows), page_size]]}
+        return json.dumps(page).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            market = "futures" if "/markets/forts/" in url.path else "options"
+            body = bodies[market]
+            if query.get("iss.only") == ["dataversion"]:
+                body = json.dumps({"dataversion": {"columns": ["data_version", "seqnum"],
+                                                   "data": [[edition, 1]]}}).encode()
+            elif page_size:
+                body = get_page(market, int(query.get("start", ["0"])[0]))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/iss".format(server.server_port)
+
+
+def make_data(scale=1, seed=0):
+    # get_data() output for a synthetic payload
+    return get_data(client=PayloadClient(make_iss_payload(underlyings=scale, seed=seed)))
+
+
+def mask_cell_index(df_fut, df_opt, keys, columns_fut, columns_opt):
+    # the boolean masking get_dictionary used to do, kept only as a baseline for the benchmark
+    d = {}
+    for key in set(zip(*[df_fut[k] for k in keys])).union(zip(*[df_opt[k] for k in keys])):
+        d[key] = {"futures": df_fut[(df_fut[keys[0]] == key[0]) & (df_fut[keys[1]] == key[1])][columns_fut]
+                      .to_dict(orient='records'),
+                  "options": df_opt[(df_opt[keys[0]] == key[0]) & (df_opt[keys[1]] == key[1])][columns_opt]
+                      .to_dict(orient='records')}
+    return d
+
+
+def measure(stages, name, func, *args):
+    # wall time and peak python memory of one stage
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stages[name] = {"seconds": round(seconds, 4), "peak_mb": round(peak / 2 ** 20, 2)}
+    return result
+
+
+def get_page(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError("{} answered {}".format(url, response.status_code))
+    return response
+
+
+def bench_cell_index(scales=(1, 2, 4, 8)):
+    keys = ["ASSETCODE", "LASTTRADEMONTH"]
+    columns = ["SECID", "SHORTNAME", "LASTTRADEDATE", "PREVOPENPOSITION", "OI_RUB", "OI_PERCENTAGE"]
+
+    print("{:>6} {:>12} {:>12} {:>12} {:>12}".format("scale", "instruments", "masks, s", "grouped, s", "get_table, s"))
+    for scale in scales:
+        data = make_data(scale)
+        args = [data["futures"], data["options"], keys, columns, columns + ["UNDERLYING"]]
+        stages = {}
+        for name, func in [("masks", mask_cell_index), ("grouped", get_cell_index)]:
+            measure(stages, name, func, *args)
+        measure(stages, "get_table", get_table, data)
+        print("{:>6} {:>12} {:>12.4f} {:>12.4f} {:>12.4f}".format(
+            scale, len(data["futures"]) + len(data["options"]), stages["masks"]["seconds"],
+            stages["grouped"]["seconds"], stages["get_table"]["seconds"]))
+
+
+def seed_underlyings(db, Underlying, payload):
+    assetcodes = sorted(set(row[3] for row in payload["futures"]))
+    for i, assetcode in enumerate(assetcodes):
+        db.session.add(Underlying(id=i + 1, underlying=assetcode, name=assetcode, section_id=i % len(SECTIONS),
+                                  section=SECTIONS[i % len(SECTIONS)], quote='', exp_clearing='', exp_type='',
+                                  web_page='', date_created=datetime.utcnow()))
+    db.session.commit()
+
+
+def bench_pipeline(scale, dimension, database_url):
+    # every stage of a refresh and of a page view on a fresh database
+    import app as application
+    from models import db, Underlying
+
+    multipliers = {"underlyings": 1, "futures": 1, "strikes": 1}
+    for name in (multipliers if dimension == "all" else [dimension]):
+        multipliers[name] = scale
+    payload = make_iss_payload(**multipliers)
+    server, base_url = start_iss_server(payload)
+    iss.client = iss.IssClient(base_url)
+
+    stages = {}
+    flask_app = application.app
+    flask_app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_underlyings(db, Underlying, payload)
+
+        data = measure(stages, "get_data", get_data)
+        df_fut, df_opt = measure(stages, "update_futopt_tables", application.update_futopt_tables, 0, 0)
+        measure(stages, "update_underlying", application.update_underlying, df_fut)
+        measure(stages, "update_matrix", application.update_matrix)
+        db.session.commit()
+        frames = measure(stages, "read_frames", application.read_frames)
+        measure(stages, "get_dictionary", application.get_dictionary, frames["cells"], frames["futures"],
+                frames["options"])
+        measure(stages, "get_table", get_table, data)
+
+        client = flask_app.test_client()
+        application.snapshot_cache.clear()
+        measure(stages, "index_cold", get_page, client, "/")
+        measure(stages, "index_cached", get_page, client, "/")
+        db.session.remove()
+    server.shutdown()
+
+    return {"instruments": len(payload["futures"]) + len(payload["options"]), "stages": stages}
+
+
+def fill_database(application, payload, database_url=""):
+    # a fresh database with the payload written by the refresh stages, Out: [futures, options] frames
+    from models import db, Underlying
+
+    iss.client = PayloadClient(payload)
+    application.app.config["SQLALCHEMY_DATABASE_URI"] = database_url or "sqlite:///{}".format(
+        os.path.join(tempfile.mkdtemp(), "bench.db"))
+    db.drop_all()
+    db.create_all()
+    seed_underlyings(db, Underlying, payload)
+    df_fut, df_opt = application.update_futopt_tables(0, 0)
+    application.update_underlying(df_fut)
+    db.session.commit()
+    return [df_fut, df_opt]
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def load_previous(path, scale, dimension, database):
+    # the last stored run with the same parameters
+    previous = None
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                result = json.loads(line)
+                if (result["scale"], result["dimension"], result["database"]) == (scale, dimension, database):
+                    previous = result
+    return previous
+
+
+def print_result(result, previous):
+    print("scale {} x {} ({} instruments), {}".format(result["scale"], result["dimension"],
+                                                      result["instruments"], result["database"]))
+    print("{:<22} {:>10} {:>10} {:>16}".format("stage", "seconds", "peak, MB", "vs " + (previous or {})
+                                               .get("commit", "-")))
+    for name, stage in result["stages"].items():
+        change = ""
+        if previous and name in previous["stages"] and previous["stages"][name]["seconds"]:
+            change = "{:+.0%}".format(stage["seconds"] / previous["stages"][name]["seconds"] - 1)
+        print("{:<22} {:>10.4f} {:>10.2f} {:>16}".format(name, stage["seconds"], stage["peak_mb"], change))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="benchmarks of the ingestion and rendering pipeline")
+    parser.add_argument("--scales", default="1,10", help="comma separated multipliers, e.g. 1,10,100")
+    parser.add_argument("--dimension", default="underlyings", choices=["all", "underlyings", "futures", "strikes"],
+                        help="what the multiplier scales")
+    parser.add_argument("--database", default="",
+                        help="SQLAlchemy url, a temporary sqlite file by default, e.g. postgresql://localhost/bench")
+    parser.add_argument("--output", default=RESULTS_FILE, help="jsonl file the results are appended to")
+    parser.add_argument("--cell-index", action="store_true", help="only compare the cell index with the masks")
+    args = parser.parse_args(argv)
+    scales = [int(scale) for scale in args.scales.split(",")]
+
+    if args.cell_index:
+        bench_cell_index(scales)
+        return
+
+    for scale in scales:
+        database_url = args.database or "sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "bench.db"))
+        result = {"commit": get_commit(),
+                  "date": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+                  "scale": scale,
+                  "dimension": args.dimension,
+                  "database": database_url.split(":")[0]}
+        result.update(bench_pipeline(scale, args.dimension, database_url))
+
+        print_result(result, load_previous(args.output, scale, args.dimension, result["database"]))
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
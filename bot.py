@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from functions import TELEGRAM_TOKEN, TELEGRAM_URL, get_url
+
+
+# chat id -> subscribed underlyings, an empty list is every underlying; required, a file on a persistent disk
+# outside of the code, which is replaced by every deploy
+SUBSCRIPTIONS_FILE = os.environ.get("SUBSCRIPTIONS_FILE", "")
+# local time of the daily expiry digest
+DIGEST_TIME = os.environ.get("DIGEST_TIME", "09:00")
+# seconds a getUpdates call waits for new messages
+POLL_TIMEOUT = 30
+# telegram limits: about 30 messages a second in total and 1 a second to the same chat
+RATE_LIMIT = 25
+CHAT_RATE_LIMIT = 1
+MESSAGE_LIMIT = 4096
+# retries of a request answered by 429 too many requests
+MAX_RETRIES = 3
+
+logger = logging.getLogger("bot")
+
+HELP_TEXT = "/subscribe Si BR - дайджест экспираций по базовым активам, /subscribe all - по всем\n" \
+            "/unsubscribe Si - отписаться от актива, /unsubscribe - от всех\n" \
+            "/list - подписки\n" \
+            "/today - экспирации сегодня, /today 2020-09-17 - на дату"
+
+
+class RateLimiter:
+    # spaces the callers out by 1 / rate seconds
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def load_subscriptions(path=SUBSCRIPTIONS_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {int(chat_id): underlyings for chat_id, underlyings in json.load(f).items()}
+
+
+def save_subscriptions(subscriptions, path=SUBSCRIPTIONS_FILE):
+    with open(path + ".tmp", "w") as f:
+        json.dump(subscriptions, f)
+    os.replace(path + ".tmp", path)
+
+
+def split_text(text, limit=MESSAGE_LIMIT):
+    # telegram refuses longer messages, the text is cut by lines
+    lst = []
+    chunk = ""
+    for line in text.splitlines(keepends=True):
+        if chunk and len(chunk) + len(line) > limit:
+            lst.append(chunk)
+            chunk = ""
+        chunk += line
+    return lst + [chunk] if chunk else lst
+
+
+def get_stored_digest(date, underlyings):
+    # from the Future / Option tables through the snapshot of app, ISS is not asked
+    import app
+    with app.app.app_context():
+        lst = app.get_expiry_report(date, underlyings)
+        app.db.session.remove()
+    return lst
+
+
+class Bot:
+    def __init__(self, base_url=TELEGRAM_URL, token=TELEGRAM_TOKEN, subscriptions_file=SUBSCRIPTIONS_FILE,
+                 get_digest=get_stored_digest, digest_time=DIGEST_TIME):
+        # In: get_digest(date, underlyings) -> [html text], blocking, it is run in a thread
+        self.url = get_url(base_url, token)
+        self.subscriptions_file = subscriptions_file
+        self.subscriptions = load_subscriptions(subscriptions_file)
+        self.get_digest = get_digest
+        self.digest_time = datetime.strptime(digest_time, "%H:%M").time()
+        self.session = None
+        self.offset = None
+        self.tasks = set()
+        self.rate_limiter = None
+        self.chat_limiters = {}
+
+    async def request(self, method, **params):
+        for retry in range(MAX_RETRIES + 1):
+            async with self.session.post(self.url + method, json=params,
+                                         timeout=aiohttp.ClientTimeout(total=POLL_TIMEOUT + 10)) as r:
+                data = await r.json()
+            # 429 tells how long to wait before the next try
+            retry_after = data.get("parameters", {}).get("retry_after")
+            if data.get("ok") or retry_after is None or retry == MAX_RETRIES:
+                break
+            await asyncio.sleep(retry_after)
+        return data
+
+    async def send(self, chat_id, text):
+        if chat_id not in self.chat_limiters:
+            self.chat_limiters[chat_id] = RateLimiter(CHAT_RATE_LIMIT)
+        for chunk in split_text(text):
+            await self.chat_limiters[chat_id].wait()
+            await self.rate_limiter.wait()
+            await self.request("sendMessage", chat_id=chat_id, text=chunk, parse_mode="HTML")
+
+    async def get_updates(self):
+        data = await self.request("getUpdates", offset=self.offset, timeout=POLL_TIMEOUT,
+                                  allowed_updates=["message"])
+        updates = data.get("result", [])
+        # the next call confirms these updates, telegram does not send them again
+        if updates:
+            self.offset = updates[-1]["update_id"] + 1
+        return updates
+
+    def start_task(self, coroutine):
+        # a slow chat must not hold the polling loop, tasks are kept until they are done
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.on_task_done)
+        return task
+
+    def on_task_done(self, task):
+        # an error of one chat is logged, the other chats and the polling go on
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("a chat task failed", exc_info=task.exception())
+
+    async def poll(self):
+        while True:
+            try:
+                updates = await self.get_updates()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                message = update.get("message", {})
+                if "text" in message:
+                    self.start_task(self.handle(message["chat"]["id"], message["text"]))
+
+    async def handle(self, chat_id, text):
+        if not text.split():
+            return
+        command, *args = text.split()
+        command = command.split("@")[0].lower()
+        if command == "/subscribe":
+            underlyings = set(self.subscriptions.get(chat_id, []))
+            self.subscriptions[chat_id] = [] if not args or "all" in args else sorted(underlyings | set(args))
+            save_subscriptions(self.subscriptions, self.subscriptions_file)
+            await self.send(chat_id, "Подписки: {}".format(", ".join(self.subscriptions[chat_id]) or "все активы"))
+        elif command == "/unsubscribe":
+            underlyings = [u for u in self.subscriptions.get(chat_id, []) if u not in args]
+            if args and underlyings:
+                self.subscriptions[chat_id] = underlyings
+            else:
+                self.subscriptions.pop(chat_id, None)
+            save_subscriptions(self.subscriptions, self.subscriptions_file)
+            await self.send(chat_id, "Подписки: {}".format(", ".join(self.subscriptions.get(chat_id, [])) or "нет"))
+        elif command == "/list":
+            if chat_id in self.subscriptions:
+                await self.send(chat_id, "Подписки: {}".format(", ".join(self.subscriptions[chat_id]) or "все активы"))
+            else:
+                await self.send(chat_id, "Подписок нет")
+        elif command == "/today":
+            try:
+                date = datetime.strptime(args[0], "%Y-%m-%d").date() if args else datetime.now().date()
+            except ValueError:
+                await self.send(chat_id, "Дата в формате 2020-09-17")
+                return
+            lst = await self.build_digest(date, self.subscriptions.get(chat_id, []))
+            for text in lst or ["Нет экспираций на {}".format(date.strftime("%Y-%m-%d"))]:
+                await self.send(chat_id, text)
+        else:
+            await self.send(chat_id, HELP_TEXT)
+
+    async def build_digest(self, date, underlyings):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.get_digest, date, underlyings)
+
+    async def send_digests(self, date):
+        # one digest per distinct set of underlyings, shared by every chat with that set
+        groups = {}
+        for chat_id, underlyings in self.subscriptions.items():
+            groups.setdefault(tuple(sorted(underlyings)), []).append(chat_id)
+
+        sends = []
+        for underlyings, chats in groups.items():
+            lst = await self.build_digest(date, list(underlyings))
+            for text in lst:
+                sends += [self.send(chat_id, text) for chat_id in chats]
+        await asyncio.gather(*sends)
+        return len(sends)
+
+    def get_next_digest(self, now):
+        next_time = datetime.combine(now.date(), self.digest_time)
+        return next_time if next_time > now else next_time + timedelta(days=1)
+
+    async def digest_worker(self):
+        while True:
+            next_time = self.get_next_digest(datetime.now())
+            await asyncio.sleep((next_time - datetime.now()).total_seconds())
+            try:
+                await self.send_digests(next_time.date())
+            except Exception:
+                # e.g. a database error of get_digest, the polling and the next digests go on
+                logger.exception("the digest of %s is not sent", next_time.date())
+
+    async def run(self):
+        self.rate_limiter = RateLimiter(RATE_LIMIT)
+        async with aiohttp.ClientSession() as self.session:
+            await asyncio.gather(self.poll(), self.digest_worker())
+
+
+def main():
+    # the bot reads the stored data only, the refresh stays with the web workers
+    if not SUBSCRIPTIONS_FILE:
+        sys.exit("SUBSCRIPTIONS_FILE is not set: a path on a persistent disk for the subscriptions of the chats")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(Bot().run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import io
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, bindparam, tuple_
+
+
+BATCH_SIZE = 5000
+
+
+def get_records(df, columns):
+    # object dtype turns numpy scalars into python ones and lets NaN become NULL
+    df = df[columns].astype(object)
+    return df.where(df.notnull(), None).to_dict(orient="records")
+
+
+def copy_frame(connection, table, df, columns):
+    buffer = io.StringIO()
+    df[columns].to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert("COPY {} ({}) FROM STDIN WITH CSV".format(table.name, ", ".join(columns)), buffer)
+
+
+def write_frame(session, model, df, batch_size=BATCH_SIZE):
+    # writes a whole frame into the model table or into a Table, frame columns are named as the table columns
+    table = getattr(model, "__table__", model)
+    df = df.assign(date_created=datetime.utcnow())
+    columns = [column.name for column in table.columns if column.name in df.columns]
+
+    start = time.perf_counter()
+    connection = session.connection()
+    if connection.dialect.name == "postgresql" and hasattr(connection.connection.cursor(), "copy_expert"):
+        copy_frame(connection, table, df, columns)
+    else:
+        records = get_records(df, columns)
+        for i in range(0, len(records), batch_size):
+            connection.execute(table.insert(), records[i:i + batch_size])
+    seconds = time.perf_counter() - start
+
+    return {"table": table.name,
+            "rows": len(df),
+            "seconds": seconds,
+            "rows_per_second": len(df) / seconds if seconds else float(len(df))}
+
+
+def get_changed(df, columns):
+    # compares "<column>" with "<column>_db", float columns with a tolerance for the database round trip
+    changed = np.zeros(len(df), dtype=bool)
+    for column in columns:
+        new, old = df[column], df[column + "_db"]
+        if pd.api.types.is_numeric_dtype(new) and pd.api.types.is_numeric_dtype(old):
+            changed |= ~np.isclose(new.astype(float), old.astype(float), rtol=1e-9, equal_nan=True)
+        else:
+            changed |= (new != old).values
+    return changed
+
+
+def upsert_frame(session, model, df, keys, compare_columns, batch_size=BATCH_SIZE):
+    # diff of a fresh frame against the stored rows by keys: inserts new rows, updates the rows where
+    # any of compare_columns changed and deletes the rows which are not in the frame any more
+    table = model.__table__
+    connection = session.connection()
+    start = time.perf_counter()
+
+    query = session.query(*[table.c[column] for column in keys + compare_columns])
+    df_db = pd.read_sql(query.statement, connection)
+    df = df.drop_duplicates(keys)
+    merged = df.merge(df_db, on=keys, how="outer", suffixes=("", "_db"), indicator=True)
+
+    df_insert = merged.loc[merged["_merge"] == "left_only", df.columns]
+    df_delete = merged.loc[merged["_merge"] == "right_only", keys]
+    df_both = merged[merged["_merge"] == "both"]
+    df_update = df_both.loc[get_changed(df_both, compare_columns), keys + compare_columns]
+
+    if not df_insert.empty:
+        write_frame(session, model, df_insert, batch_size)
+
+    if not df_update.empty:
+        # bind names must differ from the column names in an UPDATE
+        statement = table.update()\
+            .where(and_(*[table.c[column] == bindparam("key_" + column) for column in keys]))\
+            .values({column: bindparam("new_" + column) for column in compare_columns + ["date_created"]})
+        df_update = df_update.assign(date_created=datetime.utcnow())
+        df_update.columns = ["key_" + column for column in keys] + \
+                            ["new_" + column for column in compare_columns + ["date_created"]]
+        records = get_records(df_update, list(df_update.columns))
+        for i in range(0, len(records), batch_size):
+            connection.execute(statement, records[i:i + batch_size])
+
+    if not df_delete.empty:
+        key_values = list(df_delete.astype(object).itertuples(index=False, name=None))
+        for i in range(0, len(key_values), batch_size):
+            connection.execute(table.delete().where(tuple_(*[table.c[column] for column in keys])
+                                                    .in_(key_values[i:i + batch_size])))
+
+    seconds = time.perf_counter() - start
+    rows = len(df_insert) + len(df_update) + len(df_delete)
+    return {"table": table.name,
+            "inserted": len(df_insert),
+            "updated": len(df_update),
+            "deleted": len(df_delete),
+            "unchanged": len(df_both) - len(df_update),
+            "seconds": seconds,
+            "rows": rows,
+            "rows_per_second": rows / seconds if seconds else float(rows)}
@@ -0,0 +1,95 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+# strike level options of the last editions: <CHAIN_DIR>/<options edition>.parquet
+CHAIN_DIR = os.environ.get("CHAIN_DIR", os.path.join(tempfile.gettempdir(), "derivative_map_chains"))
+CHAIN_KEEP = 3
+COLUMNS = ["secid", "series", "assetcode", "underlying", "optiontype", "strike", "lasttradedate", "prevopenposition",
+           "oi_rub"]
+PROFILE_COLUMNS = pd.MultiIndex.from_product([["prevopenposition", "oi_rub"], ["C", "P"]])
+
+
+def is_enabled():
+    return pyarrow is not None and bool(CHAIN_DIR)
+
+
+def get_chain_frame(df_strikes):
+    # In: get_data()["strikes"], Out: rows sorted by series and strike, repeated strings are stored as categories
+    df = df_strikes.rename(columns=str.lower)[COLUMNS].dropna(subset=["strike"])\
+        .astype({"series": "category", "assetcode": "category", "underlying": "category", "optiontype": "category",
+                 "strike": "float64", "prevopenposition": "int32", "oi_rub": "float32"})
+    df["lasttradedate"] = pd.to_datetime(df["lasttradedate"])
+    return df.sort_values(["series", "strike", "optiontype"]).reset_index(drop=True)
+
+
+def save(data):
+    # In: get_data() output, Out: path of the written file or None if this edition is stored already
+    if not is_enabled():
+        return None
+
+    path = os.path.join(CHAIN_DIR, "{}.parquet".format(data["option_edition"]))
+    if os.path.exists(path):
+        return None
+
+    os.makedirs(CHAIN_DIR, exist_ok=True)
+    get_chain_frame(data["strikes"]).to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+    # workers may still read the previous editions, only older ones are removed
+    files = sorted([f for f in os.listdir(CHAIN_DIR) if f.endswith(".parquet")],
+                   key=lambda f: os.path.getmtime(os.path.join(CHAIN_DIR, f)))
+    for f in files[:-CHAIN_KEEP]:
+        os.remove(os.path.join(CHAIN_DIR, f))
+    return path
+
+
+def load(edition):
+    path = os.path.join(CHAIN_DIR, "{}.parquet".format(edition))
+    if not is_enabled() or not os.path.exists(path):
+        return None
+    return ChainIndex(pd.read_parquet(path))
+
+
+class ChainIndex:
+    # rows of a series are one slice of the sorted frame, the slices are found once
+    def __init__(self, df):
+        self.df = df
+        series = df["series"].astype(object).values
+        starts = np.flatnonzero(np.r_[True, series[1:] != series[:-1]])
+        ends = np.r_[starts[1:], len(series)]
+        self.bounds = dict(zip(series[starts], zip(starts, ends)))
+
+    def get_chain(self, series):
+        # Out: OI by strike of calls and puts of the series, None for an unknown series
+        if series not in self.bounds:
+            return None
+        start, end = self.bounds[series]
+        df = self.df.iloc[start:end]
+
+        # a series of calls only or of puts only still gets both columns
+        df_profile = df.groupby(["strike", df["optiontype"].astype(object)])[["prevopenposition", "oi_rub"]].sum()\
+            .unstack(fill_value=0).reindex(columns=PROFILE_COLUMNS, fill_value=0)
+        strikes = [{"strike": float(strike),
+                    "call_oi": int(row[("prevopenposition", "C")]), "put_oi": int(row[("prevopenposition", "P")]),
+                    "call_oi_rub": float(row[("oi_rub", "C")]), "put_oi_rub": float(row[("oi_rub", "P")])}
+                   for strike, row in df_profile.iterrows()]
+
+        call_oi = int(df_profile[("prevopenposition", "C")].sum())
+        put_oi = int(df_profile[("prevopenposition", "P")].sum())
+        return {"series": series,
+                "assetcode": str(df["assetcode"].iloc[0]),
+                "underlying": str(df["underlying"].iloc[0]),
+                "lasttradedate": df["lasttradedate"].iloc[0],
+                "call_oi": call_oi,
+                "put_oi": put_oi,
+                "put_call_ratio": put_oi / call_oi if call_oi else None,
+                "strikes": strikes}
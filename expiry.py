@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+from functions import make_html_text
+
+
+COLUMNS = ["secid", "shortname", "assetcode", "lasttradedate", "prevopenposition", "oi_rub"]
+
+class ExpiryIndex:
+    # futures and options sorted by the last trading day, a date range is two binary searches
+    def __init__(self, df_fut, df_opt, df_undrl):
+        df = pd.concat([df_fut[COLUMNS].assign(type="F"), df_opt[COLUMNS + ["underlying_future"]].assign(type="O")],
+                       ignore_index=True, sort=False)
+        df["section"] = df["assetcode"].astype(object).map(df_undrl["section"]).fillna("").astype("category")
+        df["type"] = df["type"].astype("category")
+        df["lasttradedate"] = pd.to_datetime(df["lasttradedate"]).dt.normalize()
+        self.df = df.sort_values(["lasttradedate", "type", "oi_rub"], ascending=[True, True, False])\
+            .reset_index(drop=True)
+        self.dates = self.df["lasttradedate"].values
+
+    def get_range(self, start, end=None, section=None, underlyings=None):
+        # In: dates of [start, end], end=None - only start, Out: slice of the sorted frame
+        i = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start).normalize()), side="left")
+        j = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end or start).normalize()), side="right")
+        df = self.df.iloc[i:j]
+        if section:
+            df = df[df["section"] == section]
+        if underlyings:
+            df = df[df["assetcode"].isin(underlyings)]
+        return df
+
+    def get_report(self, date, underlyings=None):
+        # the "last trading day today" messages of make_html_text, Out: [html of futures, html of options]
+        lst = []
+        df = self.get_range(date, underlyings=underlyings)
+        for type_instr, instrument_type, sort_by in [("futures", "F", "prevopenposition"), ("options", "O", "oi_rub")]:
+            df_type = df[df["type"] == instrument_type].sort_values(sort_by, ascending=False)
+            if not df_type.empty:
+                lst.append(make_html_text(pd.Timestamp(date).strftime("%Y-%m-%d"), type_instr,
+                                          df_type.rename(columns=str.upper)))
+        return lst
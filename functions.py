@@ -1,30 +1,22 @@
-import requests
+import os
 import pandas as pd
 import numpy as np
 import re
 
+from iss import get_client
 
 
-def get_updates():
-    url = get_url() + "getupdates"
-    r = requests.get(url)
-    return r.json()
+TELEGRAM_URL = os.environ.get("TELEGRAM_URL", "https://api.telegram.org")
+TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "")
 
 
-def get_message():
-    data = get_updates()
+def get_url(base_url=TELEGRAM_URL, token=TELEGRAM_TOKEN):
+    # In: a stand-in server url for tests, Out: ".../bot<token>/"
+    return "{}/bot{}/".format(base_url.rstrip("/"), token)
 
-    chat_id = data["result"][-1]["message"]["chat"]["id"]
-    message_text = data["result"][-1]["message"]["text"]
 
-    message = {"chat_id": chat_id, "message_text": message_text}
-
-    return message
-
-
-def send_message(chat_id, text="hold on please..."):
-    url = get_url() + "sendmessage?chat_id={}&parse_mode=HTML&text={}".format(chat_id, text)
-    requests.get(url)
+def get_colors():
+    return {0: "#f8f9fa", 1: "#e9ecef", 2: "#dee2e6", 3: "#ced4da", 4: "#adb5bd", 5: "#868e96"}
 
 
 def get_option_series_name(s):
@@ -60,35 +52,106 @@ def short_number(number):
         return "0"
 
 
-def get_data(exp_date=None):
+def group_records(df, keys, columns):
+    # one pass over the frame, In: keys ["assetcode", "lasttrademonth"]
+    # Out: {("Si", "2020 Sep"): [{"secid": ..., ...}, ...], ...}
+    d = {}
+    records = df[columns].to_dict(orient='records')
+    for key, record in zip(zip(*[df[k].values for k in keys]), records):
+        d.setdefault(key, []).append(record)
+    return d
+
+
+def get_cell_index(df_fut, df_opt, keys, columns_fut, columns_opt):
+    index_fut = group_records(df_fut, keys, columns_fut)
+    index_opt = group_records(df_opt, keys, columns_opt)
+    return {key: {"futures": index_fut.get(key, []), "options": index_opt.get(key, [])}
+            for key in set(index_fut).union(index_opt)}
+
+
+def get_option_underlying_vec(option_names):
+    # vectorized get_option_underlying: everything before the first "M<ddmmyy>"
+    return option_names.str.replace(r"M\d{6}.*$", "", regex=True)
+
+
+def get_option_series_name_vec(option_names):
+    # vectorized get_option_series_name
+    return option_names.str.replace(r"[CP]A[\d\.\-]+$", "", regex=True)
+
+
+def get_option_parts_vec(option_names):
+    # one regex pass, In: "Si-9.20M170920CA73000" Out: underlying "Si-9.20", series "Si-9.20M170920",
+    # optiontype "C", strike 73000.0; names of another form give NaN
+    df = option_names.str.extract(r"^(.+?)M(\d{6})([CP])A([\d\.\-]+)$")
+    return pd.DataFrame({"UNDERLYING": df[0], "SERIES": df[0] + "M" + df[1], "OPTIONTYPE": df[2],
+                         "STRIKE": pd.to_numeric(df[3], errors="coerce")}, index=option_names.index)
+
+
+def get_year_month_vec(dates):
+    # vectorized get_year_month for a datetime series or a PeriodIndex
+    if isinstance(dates, pd.Series):
+        return dates.dt.strftime("%Y %b")
+    return pd.Index(dates.strftime("%Y %b"))
+
+
+def round_up_log_vec(numbers, base, n_groups):
+    # vectorized round_up_log, int() and astype(int) both truncate towards zero
+    log_numbers = np.log(np.asarray(numbers, dtype=float) + 1.0)
+    step = np.log(base + 1.0001)/(n_groups-1)
+    return (log_numbers/step - 0.00001).astype(int) + (log_numbers % step > 0)
+
+
+def get_colors_vec(numbers, base):
+    # colors of all cells at once, buckets above the palette get the darkest color as in get_table
+    d_colors = get_colors()
+    palette = np.array([d_colors[i] for i in range(len(d_colors))], dtype=object)
+    return palette[np.clip(round_up_log_vec(numbers, base, len(d_colors)), 0, len(d_colors) - 1)]
+
+
+def short_number_vec(numbers):
+    # vectorized short_number, only the final formatting is done per number
+    d = {0: "", 1: "K", 2: "M", 3: "B"}
+    numbers = np.asarray(numbers, dtype=float)
+    finite = np.isfinite(numbers)
+    ints = np.where(finite, np.trunc(numbers), 0).astype(np.int64)
+    power = (np.char.str_len(ints.astype(str)) - 1)//3
+    devisor = 10.0**(3*power)
+    one_digit = (numbers/devisor < 10) & (numbers >= 10)
+
+    lst = []
+    for number, power_i, devisor_i, one_digit_i, finite_i in zip(numbers, power, devisor, one_digit, finite):
+        if not finite_i:
+            lst.append("0")
+        elif one_digit_i:
+            lst.append("{}{}".format(round(number/devisor_i, 1), d[power_i]))
+        else:
+            lst.append("{}{}".format(int(round(number/devisor_i, 0)), d[power_i]))
+    return lst
+
+
+def get_data(exp_date=None, client=None):
     columns_input = ["SECID", "SHORTNAME", "LASTTRADEDATE", "ASSETCODE", "PREVOPENPOSITION", "PREVSETTLEPRICE",
                      "MINSTEP", "STEPPRICE"]
 
-    # futures
-    url_fut = "https://iss.moex.com/iss/engines/futures/markets/forts/securities.json?iss.only=securities&securities.columns={}".format(
-        ','.join(columns_input))
-    r_fut = requests.get(url_fut)
-    data_fut = r_fut.json()["securities"]["data"]
-    columns_fut = r_fut.json()["securities"]["columns"]
-    df_fut = pd.DataFrame(data_fut, columns=columns_fut)
-
-    # options
-    url_opt = "https://iss.moex.com/iss/engines/futures/markets/options/securities.json?iss.only=securities&securities.columns={}".format(
-        ",".join(columns_input))
-    r_opt = requests.get(url_opt)
-    data_opt = r_opt.json()["securities"]["data"]
-    columns_opt = r_opt.json()["securities"]["columns"]
-    df_opt_raw = pd.DataFrame(data_opt, columns=columns_opt)
+    # futures and options are downloaded concurrently over one connection pool
+    securities = (client or get_client()).get_all_securities(columns_input)
+    df_fut = securities["futures"]["frame"]
+    df_opt_raw = securities["options"]["frame"]
+    future_edition = securities["futures"]["edition"]
+    option_edition = securities["options"]["edition"]
 
     # deleting NaN data
     df_fut = df_fut[-df_fut["PREVOPENPOSITION"].isnull()]
     df_opt_raw = df_opt_raw[-df_opt_raw["PREVOPENPOSITION"].isnull()]
 
     # getting underlying
-    df_opt_raw["UNDERLYING"] = df_opt_raw["SHORTNAME"].apply(get_option_underlying)
+    df_opt_raw["UNDERLYING"] = get_option_underlying_vec(df_opt_raw["SHORTNAME"])
+
+    # type and strike of every option before they are cut off
+    df_opt_raw[["OPTIONTYPE", "STRIKE"]] = get_option_parts_vec(df_opt_raw["SHORTNAME"])[["OPTIONTYPE", "STRIKE"]]
 
     # getting short option names = cutting strikes and types
-    df_opt_raw["SHORTNAME"] = df_opt_raw["SHORTNAME"].apply(get_option_series_name)
+    df_opt_raw["SHORTNAME"] = get_option_series_name_vec(df_opt_raw["SHORTNAME"])
 
     # getting STEPPRICE param for options from futures
     df_opt_raw = df_opt_raw.merge(df_fut[["SHORTNAME", "STEPPRICE"]],
@@ -122,19 +185,25 @@ def get_data(exp_date=None):
     df_fut["LASTTRADEDATE"] = pd.to_datetime(df_fut["LASTTRADEDATE"])
     df_opt["LASTTRADEDATE"] = pd.to_datetime(df_opt["LASTTRADEDATE"])
 
-    df_fut["LASTTRADEMONTH"] = df_fut["LASTTRADEDATE"].apply(get_year_month)
-    df_opt["LASTTRADEMONTH"] = df_opt["LASTTRADEDATE"].apply(get_year_month)
+    df_fut["LASTTRADEMONTH"] = get_year_month_vec(df_fut["LASTTRADEDATE"])
+    df_opt["LASTTRADEMONTH"] = get_year_month_vec(df_opt["LASTTRADEDATE"])
 
     # OI_contracts to int
-    df_fut["PREVOPENPOSITION"] = df_fut["PREVOPENPOSITION"].apply(int)
-    df_opt["PREVOPENPOSITION"] = df_opt["PREVOPENPOSITION"].apply(int)
+    df_fut["PREVOPENPOSITION"] = df_fut["PREVOPENPOSITION"].astype("int64")
+    df_opt["PREVOPENPOSITION"] = df_opt["PREVOPENPOSITION"].astype("int64")
 
     columns_output_fut = ["SECID", "SHORTNAME", "LASTTRADEDATE", "ASSETCODE", "PREVOPENPOSITION",
                           "PREVSETTLEPRICE", "OI_RUB", "OI_PERCENTAGE", "LASTTRADEMONTH"]
     columns_output_opt = ["SECID", "SHORTNAME", "LASTTRADEDATE", "ASSETCODE", "PREVOPENPOSITION",
                           "PREVSETTLEPRICE", "OI_RUB", "OI_PERCENTAGE", "LASTTRADEMONTH", "UNDERLYING"]
 
-    return {"futures": df_fut[columns_output_fut], "options": df_opt[columns_output_opt]}
+    # options before grouping into series, for the strike level chain
+    columns_output_strikes = ["SECID", "SHORTNAME", "LASTTRADEDATE", "ASSETCODE", "UNDERLYING", "OPTIONTYPE", "STRIKE",
+                              "PREVOPENPOSITION", "OI_RUB"]
+    df_strikes = df_opt_raw[columns_output_strikes].rename(columns={"SHORTNAME": "SERIES"})
+
+    return {"futures": df_fut[columns_output_fut], "options": df_opt[columns_output_opt], "strikes": df_strikes,
+            "future_edition": future_edition, "option_edition": option_edition}
 
 
 def get_table(data_FO_dict):
@@ -146,21 +215,20 @@ def get_table(data_FO_dict):
                                  df_opt[["LASTTRADEMONTH", "ASSETCODE", "OI_RUB"]]]) \
         .groupby(["LASTTRADEMONTH", "ASSETCODE"]).sum().max().values[0]
 
-    d_colors = {0: "#f8f9fa", 1: "#e9ecef", 2: "#dee2e6", 3: "#ced4da", 4: "#adb5bd", 5: "#868e96"}
-    n_colors = len(d_colors)
-
     # getting columns
-    dates_lst = []
-    for dt in pd.period_range(start=df_fut["LASTTRADEDATE"].min(),
-                              end=df_fut["LASTTRADEDATE"].max(),
-                              freq='M'):
-        dates_lst.append(get_year_month(dt))
+    dates_lst = list(get_year_month_vec(pd.period_range(start=df_fut["LASTTRADEDATE"].min(),
+                                                        end=df_fut["LASTTRADEDATE"].max(),
+                                                        freq='M')))
 
     # initializing table
     d = {}
     columns_fut = ["SECID", "SHORTNAME", "LASTTRADEDATE", "PREVOPENPOSITION", "OI_RUB", "OI_PERCENTAGE"]
     columns_opt = ["SECID", "SHORTNAME", "LASTTRADEDATE", "PREVOPENPOSITION", "OI_RUB", "OI_PERCENTAGE", "UNDERLYING"]
 
+    cell_index = get_cell_index(df_fut, df_opt, ["ASSETCODE", "LASTTRADEMONTH"], columns_fut, columns_opt)
+    empty_cell = {"futures": [], "options": []}
+    lst_filled = []
+
     # filling cells
     for row in df_fut["ASSETCODE"].unique():
         d[row] = {}
@@ -172,29 +240,30 @@ def get_table(data_FO_dict):
             cell_OI = 0
             cell_type = set()
             cell_OI_rub = 0
+            instruments = cell_index.get((row, col), empty_cell)
 
-            for i in df_fut[(df_fut["ASSETCODE"] == row) & (df_fut["LASTTRADEMONTH"] == col)][columns_fut].values:
-                cell_OI += i[3]
-                cell_OI_rub += i[4]
+            for i in instruments["futures"]:
+                cell_OI += i["PREVOPENPOSITION"]
+                cell_OI_rub += i["OI_RUB"]
                 cell_type.add("F")
-                d[row][col]["instruments"]["futures"].append({"short_ticker": i[0],
-                                                              "ticker": i[1],
-                                                              "exp_date": i[2],
-                                                              "OI": i[3],
-                                                              "OI_RUB": i[4],
-                                                              "OI_PERCENTAGE": i[5]})
-
-            for i in df_opt[(df_opt["ASSETCODE"] == row) & (df_opt["LASTTRADEMONTH"] == col)][columns_opt].values:
-                cell_OI += i[3]
-                cell_OI_rub += i[4]
+                d[row][col]["instruments"]["futures"].append({"short_ticker": i["SECID"],
+                                                              "ticker": i["SHORTNAME"],
+                                                              "exp_date": i["LASTTRADEDATE"],
+                                                              "OI": i["PREVOPENPOSITION"],
+                                                              "OI_RUB": i["OI_RUB"],
+                                                              "OI_PERCENTAGE": i["OI_PERCENTAGE"]})
+
+            for i in instruments["options"]:
+                cell_OI += i["PREVOPENPOSITION"]
+                cell_OI_rub += i["OI_RUB"]
                 cell_type.add("O")
-                d[row][col]["instruments"]["options"].append({"short_ticker": i[0],
-                                                              "ticker": i[1],
-                                                              "exp_date": i[2],
-                                                              "OI": i[3],
-                                                              "OI_RUB": i[4],
-                                                              "OI_PERCENTAGE": i[5],
-                                                              "UNDERLYING": i[6]})
+                d[row][col]["instruments"]["options"].append({"short_ticker": i["SECID"],
+                                                              "ticker": i["SHORTNAME"],
+                                                              "exp_date": i["LASTTRADEDATE"],
+                                                              "OI": i["PREVOPENPOSITION"],
+                                                              "OI_RUB": i["OI_RUB"],
+                                                              "OI_PERCENTAGE": i["OI_PERCENTAGE"],
+                                                              "UNDERLYING": i["UNDERLYING"]})
 
             if len(cell_type) > 0:
                 if len(cell_type) == 2:
@@ -204,16 +273,20 @@ def get_table(data_FO_dict):
                 elif [e for e in cell_type][0] == 'O':
                     d[row][col]["cell"]["cell_type"] = "-/O"
 
-                d[row][col]["cell"]["cell_OI"] = short_number(cell_OI)
-                try:
-                    d[row][col]["cell"]["cell_color"] = d_colors[round_up_log(cell_OI_rub, cell_max_OI_rub, n_colors)]
-                except KeyError:
-                    d[row][col]["cell"]["cell_color"] = d_colors[n_colors - 1]
+                lst_filled.append((d[row][col]["cell"], cell_OI, cell_OI_rub))
 
             # In: d_table["BR"]["2020 Dec"]
             # Out:    {'cell': {'cell_OI': '0', 'cell_name': 'BR 2020 Dec', 'cell_type': 0},
             # Out:     'instruments': {'futures': [], 'options': []}}
 
+    # coloring and formatting of all filled cells in one call
+    if lst_filled:
+        cells, lst_OI, lst_OI_rub = zip(*lst_filled)
+        lst_colors = get_colors_vec(lst_OI_rub, cell_max_OI_rub)
+        for cell, cell_OI, cell_color in zip(cells, short_number_vec(lst_OI), lst_colors):
+            cell["cell_OI"] = cell_OI
+            cell["cell_color"] = cell_color
+
     return d
 
 
@@ -0,0 +1,24 @@
+import os
+
+import metrics
+
+
+def on_starting(server):
+    metrics.clear()
+
+
+def post_worker_init(worker):
+    # the refresh worker is started by the web workers only, importing app (flask db upgrade, flask shell,
+    # bot.py, benchmark.py) starts nothing; REFRESH_WORKER=0 - web workers only serve the stored data
+    if os.environ.get("REFRESH_WORKER", "1") == "1":
+        from app import start_refresh_worker
+        start_refresh_worker()
+
+
+def worker_exit(server, worker):
+    # the last FLUSH_INTERVAL of the worker is not lost
+    metrics.flush(force=True)
+
+
+def child_exit(server, worker):
+    metrics.retire(worker.pid)
@@ -0,0 +1,93 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+
+try:
+    import pyarrow.dataset as ds
+except ImportError:
+    ds = None
+
+
+# append-only store of every data edition: <HISTORY_DIR>/date=<YYYY-MM-DD>/<futures edition>-<options edition>.parquet;
+# a persistent directory outside of the code, not set - no history is kept and /api/history answers 501
+HISTORY_DIR = os.environ.get("HISTORY_DIR", "")
+COLUMNS = ["type", "secid", "assetcode", "lasttrademonth", "lasttradedate", "prevopenposition", "oi_rub"]
+
+
+def is_enabled():
+    return ds is not None and bool(HISTORY_DIR)
+
+
+def get_history_frame(data):
+    # one narrow frame of both instrument types, repeated strings are stored as categories
+    df_fut = data["futures"].rename(columns=str.lower).assign(type="F")
+    df_opt = data["options"].rename(columns=str.lower).assign(type="O")
+    df = pd.concat([df_fut[COLUMNS], df_opt[COLUMNS]], ignore_index=True)
+    for column in ["type", "assetcode", "lasttrademonth"]:
+        df[column] = df[column].astype("category")
+    df["prevopenposition"] = df["prevopenposition"].astype("int64")
+    # sorted rows keep the row group statistics useful for the assetcode filter
+    return df.sort_values(["assetcode", "lasttradedate"]).reset_index(drop=True)
+
+
+def append(data, date=None):
+    # In: get_data() output, Out: path of the written file or None if this edition is stored already
+    if not is_enabled():
+        return None
+
+    date = date or datetime.utcnow().date()
+    path_dir = os.path.join(HISTORY_DIR, "date={}".format(date.strftime("%Y-%m-%d")))
+    path = os.path.join(path_dir, "{}-{}.parquet".format(data["future_edition"], data["option_edition"]))
+    if os.path.exists(path):
+        return None
+
+    os.makedirs(path_dir, exist_ok=True)
+    get_history_frame(data).to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def get_files(start=None, end=None):
+    # the last edition of every date in [start, end], dates are filtered by the directory names only
+    if not is_enabled() or not os.path.isdir(HISTORY_DIR):
+        return []
+
+    start = start.strftime("%Y-%m-%d") if start else ""
+    end = end.strftime("%Y-%m-%d") if end else "9999"
+    files = []
+    for name in sorted(os.listdir(HISTORY_DIR)):
+        date = name[len("date="):]
+        if not name.startswith("date=") or not start <= date <= end:
+            continue
+        editions = sorted([f for f in os.listdir(os.path.join(HISTORY_DIR, name)) if f.endswith(".parquet")],
+                          key=lambda f: [int(e) if e.isdigit() else e for e in f[:-len(".parquet")].split("-")])
+        if editions:
+            files.append((date, os.path.join(HISTORY_DIR, name, editions[-1])))
+    return files
+
+
+def query(underlying=None, year_month=None, start=None, end=None, instrument_type=None):
+    # OI time series, In: any of underlying / expiry month / both for a cell, Out: frame with
+    # date, prevopenposition, oi_rub summed over the selected instruments of each date
+    files = get_files(start, end)
+    if not files:
+        return pd.DataFrame(columns=["date", "prevopenposition", "oi_rub"])
+
+    expression = None
+    for column, value in [("assetcode", underlying), ("lasttrademonth", year_month), ("type", instrument_type)]:
+        if value:
+            condition = ds.field(column) == value
+            expression = condition if expression is None else expression & condition
+
+    # one scan over the selected files, only the needed columns and rows are read
+    dataset = ds.dataset([path for date, path in files], format="parquet",
+                         partitioning=ds.partitioning(flavor="hive"), partition_base_dir=HISTORY_DIR)
+    table = dataset.to_table(columns=["date", "prevopenposition", "oi_rub"], filter=expression)
+    df = table.group_by("date").aggregate([("prevopenposition", "sum"), ("oi_rub", "sum")]).to_pandas()\
+        .rename(columns={"prevopenposition_sum": "prevopenposition", "oi_rub_sum": "oi_rub"})
+
+    # dates where nothing matched still belong to the series
+    df_dates = pd.DataFrame({"date": [date for date, path in files]})
+    df = df_dates.merge(df.astype({"date": str}), on="date", how="left").fillna(0)
+    return df.astype({"prevopenposition": "int64"})
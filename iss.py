@@ -0,0 +1,116 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+
+ISS_URL = os.environ.get("ISS_URL", "https://iss.moex.com/iss")
+MARKETS = {"futures": "forts", "options": "options"}
+
+# (connect, read) timeouts, seconds - a slow ISS must not hang a gunicorn worker
+TIMEOUT = (3.05, 20)
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+# an answer of more pages is not trusted: an endpoint ignoring start= would return the first page forever
+MAX_PAGES = 100
+
+
+def get_next_start(page, block, received, page_size):
+    # Out: start= of the next page or None after the last one. <block>.cursor holds INDEX, TOTAL and PAGESIZE;
+    # without it a page shorter than the first one is the last
+    cursor = page.get(block + ".cursor")
+    if cursor and cursor["data"]:
+        row = dict(zip(cursor["columns"], cursor["data"][0]))
+        start = row["INDEX"] + row["PAGESIZE"]
+        return start if start < row["TOTAL"] else None
+    if not page[block]["data"] or len(page[block]["data"]) < page_size:
+        return None
+    return received
+
+
+class IssClient:
+    def __init__(self, base_url=ISS_URL, timeout=TIMEOUT, retries=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                 pool_size=4):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def securities_url(self, market):
+        return "{}/engines/futures/markets/{}/securities.json".format(self.base_url, MARKETS[market])
+
+    def get_json(self, url, params=None):
+        start = time.perf_counter()
+        r = self.session.get(url, params=params, timeout=self.timeout)
+        r.raise_for_status()
+        path = urlparse(url).path
+        metrics.observe("iss_request_seconds", time.perf_counter() - start, path=path)
+        metrics.inc("iss_response_bytes_total", len(r.content), path=path)
+        return r.json()
+
+    def get_block(self, url, block, params=None, paginate=False):
+        # In: block "securities", Out: {"columns": [...], "data": [...], "dataversion": <json of first page>}
+        params = dict(params or {})
+        if paginate and "iss.only" in params:
+            params["iss.only"] += ",{}.cursor".format(block)
+        page = self.get_json(url, params)
+        result = {"columns": page[block]["columns"], "data": page[block]["data"], "page": page}
+
+        # ISS cuts long answers into pages, the next one is asked by start=
+        page_size = len(page[block]["data"])
+        pages = 1
+        start = get_next_start(page, block, len(result["data"]), page_size)
+        while paginate and start is not None:
+            if pages == MAX_PAGES:
+                raise RuntimeError("{} has more than {} pages of {}".format(url, MAX_PAGES, block))
+            params["start"] = start
+            page = self.get_json(url, params)
+            pages += 1
+            result["data"].extend(page[block]["data"])
+            start = get_next_start(page, block, len(result["data"]), page_size)
+        return result
+
+    def get_securities(self, market, columns, paginate=False):
+        params = {"iss.only": "securities,dataversion", "securities.columns": ",".join(columns)}
+        result = self.get_block(self.securities_url(market), "securities", params, paginate)
+        return {"frame": pd.DataFrame(result["data"], columns=result["columns"]),
+                "edition": result["page"]["dataversion"]["data"][0][0]}
+
+    def get_edition(self, market):
+        return self.get_json(self.securities_url(market), {"iss.only": "dataversion"})["dataversion"]["data"][0][0]
+
+    def map(self, func, markets, *args):
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            results = executor.map(lambda market: func(market, *args), markets)
+            return dict(zip(markets, results))
+
+    def get_all_securities(self, columns, paginate=False):
+        # Out: {"futures": {"frame": df, "edition": ...}, "options": {...}}, both markets are fetched concurrently
+        return self.map(self.get_securities, list(MARKETS), columns, paginate)
+
+    def get_all_editions(self):
+        return self.map(self.get_edition, list(MARKETS))
+
+
+client = None
+
+
+def get_client():
+    # one keep-alive connection pool per process
+    global client
+    if client is None:
+        client = IssClient()
+    return client
@@ -0,0 +1,195 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+
+# every gunicorn worker dumps its metrics here, /metrics sums the files of all workers
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "derivative_map_metrics"))
+FLUSH_INTERVAL = 1.0
+# seconds between stack samples of the optional profiler, e.g. 0.01; not set - no profiler
+PROFILE_SAMPLING_INTERVAL = float(os.environ.get("PROFILE_SAMPLING_INTERVAL", 0))
+PROFILE_DUMP_INTERVAL = 60
+
+lock = threading.Lock()
+counters = {}
+summaries = {}
+last_flush = {"time": 0.0}
+
+
+def get_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = get_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+    flush()
+
+
+def observe(name, value, **labels):
+    key = get_key(name, labels)
+    with lock:
+        total, count = summaries.get(key, (0.0, 0))
+        summaries[key] = (total + value, count + 1)
+    flush()
+
+
+@contextmanager
+def timer(stage, **labels):
+    # In: with timer("get_data"): ... Out: stage_seconds{stage="get_data"} summary
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+
+def timed(stage):
+    # decorator form of timer
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def flush(force=False):
+    # a json file per process, written atomically and not more often than FLUSH_INTERVAL
+    now = time.time()
+    if not force and now - last_flush["time"] < FLUSH_INTERVAL:
+        return
+    last_flush["time"] = now
+
+    with lock:
+        entries = [{"type": "counter", "name": name, "labels": dict(labels), "value": value}
+                   for (name, labels), value in counters.items()]
+        entries += [{"type": "summary", "name": name, "labels": dict(labels), "sum": total, "count": count}
+                    for (name, labels), (total, count) in summaries.items()]
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, "{}.json".format(os.getpid()))
+        with open(path + ".tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def read_entries(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def add_entries(d, entries):
+    # In: {(type, name, labels): [value] or [sum, count]} and the entries of a file
+    for entry in entries:
+        key = (entry["type"], entry["name"], tuple(sorted(entry["labels"].items())))
+        values = [entry["value"]] if entry["type"] == "counter" else [entry["sum"], entry["count"]]
+        d[key] = [a + b for a, b in zip(d[key], values)] if key in d else values
+    return d
+
+
+def write_entries(path, d):
+    entries = [{"type": metric_type, "name": name, "labels": dict(labels), "value": values[0]}
+               if metric_type == "counter" else
+               {"type": metric_type, "name": name, "labels": dict(labels), "sum": values[0], "count": values[1]}
+               for (metric_type, name, labels), values in d.items()]
+    with open(path + ".tmp", "w") as f:
+        json.dump(entries, f)
+    os.replace(path + ".tmp", path)
+
+
+def collect():
+    # sums the metrics of all workers, Out: {(type, name, labels): [value] or [sum, count]}
+    flush(force=True)
+    d = {}
+    for file_name in os.listdir(METRICS_DIR):
+        if file_name.endswith(".json"):
+            add_entries(d, read_entries(os.path.join(METRICS_DIR, file_name)))
+    return d
+
+
+def clear():
+    # a new gunicorn master starts from zero, files of workers of the previous one are not summed any more
+    if os.path.isdir(METRICS_DIR):
+        for file_name in os.listdir(METRICS_DIR):
+            if file_name.endswith(".json") or file_name.endswith(".tmp"):
+                os.remove(os.path.join(METRICS_DIR, file_name))
+
+
+def retire(pid):
+    # an exited worker: its metrics are added to retired.json, so the sums never go back and a new
+    # worker with the same pid starts its own file; called by the gunicorn master only
+    path = os.path.join(METRICS_DIR, "{}.json".format(pid))
+    if not os.path.exists(path):
+        return
+    retired_path = os.path.join(METRICS_DIR, "retired.json")
+    write_entries(retired_path, add_entries(add_entries({}, read_entries(retired_path)), read_entries(path)))
+    os.remove(path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+def render():
+    # prometheus text exposition format
+    lines = []
+    typed = set()
+    for (metric_type, name, labels), values in sorted(collect().items()):
+        if (metric_type, name) not in typed:
+            typed.add((metric_type, name))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+        if metric_type == "counter":
+            lines.append("{}{} {}".format(name, format_labels(labels), values[0]))
+        else:
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), values[0]))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), values[1]))
+    return "\n".join(lines) + "\n"
+
+
+def get_stack(frame):
+    return ";".join("{}:{}".format(os.path.basename(f.filename), f.name) for f in traceback.extract_stack(frame))
+
+
+def profiler(interval, dump_interval=PROFILE_DUMP_INTERVAL):
+    # sampling profiler: counts the stacks of all other threads, dumps them in the collapsed
+    # format of flamegraph.pl to METRICS_DIR/profile-<pid>.txt
+    stacks = Counter()
+    own_id = threading.get_ident()
+    last_dump = time.time()
+    while True:
+        time.sleep(interval)
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_id:
+                stacks[get_stack(frame)] += 1
+
+        if time.time() - last_dump > dump_interval:
+            last_dump = time.time()
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            with open(os.path.join(METRICS_DIR, "profile-{}.txt".format(os.getpid())), "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write("{} {}\n".format(stack, count))
+
+
+def start_profiler(interval=PROFILE_SAMPLING_INTERVAL):
+    if not interval:
+        return None
+    thread = threading.Thread(target=profiler, args=(interval,), name="sampling-profiler", daemon=True)
+    thread.start()
+    return thread
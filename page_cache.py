@@ -0,0 +1,103 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class PageCache:
+    # rendered pages of the current data version, compressed once and dropped when the version changes;
+    # filtered pages have their own names, the least recently used go first above max_pages
+    def __init__(self, max_pages=64):
+        self.lock = threading.Lock()
+        self.version = None
+        self.pages = OrderedDict()
+        self.max_pages = max_pages
+
+    def get(self, version, name, render, last_modified):
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.pages = OrderedDict()
+            page = self.pages.get(name)
+            if page is not None:
+                self.pages.move_to_end(name)
+        if page is not None:
+            return page
+
+        page = make_page(render(), last_modified)
+        with self.lock:
+            if version == self.version:
+                self.pages[name] = page
+                while len(self.pages) > self.max_pages:
+                    self.pages.popitem(last=False)
+        return page
+
+
+def make_page(html, last_modified):
+    body = html.encode("utf-8")
+    etag = hashlib.sha1(body).hexdigest()
+    # a strong etag belongs to one representation, so every encoding gets its own
+    page = {"last_modified": last_modified.replace(microsecond=0) if last_modified else None,
+            "identity": {"body": body, "etag": etag},
+            "gzip": {"body": gzip.compress(body, compresslevel=9), "etag": etag + "-gzip"}}
+    if brotli is not None:
+        page["br"] = {"body": brotli.compress(body), "etag": etag + "-br"}
+    return page
+
+
+def get_encoding(page, request):
+    for encoding in ["br", "gzip"]:
+        if encoding in page and encoding in request.accept_encodings:
+            return encoding
+    return "identity"
+
+
+def is_not_modified(page, variant, request):
+    if request.if_none_match:
+        if variant.get("weak"):
+            return request.if_none_match.contains_weak(variant["etag"])
+        return request.if_none_match.contains(variant["etag"])
+    if request.if_modified_since and page["last_modified"]:
+        return request.if_modified_since.replace(tzinfo=None) >= page["last_modified"].replace(tzinfo=None)
+    return False
+
+
+def get_stream_response(body, key, last_modified, request):
+    # In: a generator of the page, key - data version and page name; the body is not known before it is sent,
+    # so the etag is a weak one of the key and the generator is not even started for a 304
+    page = {"last_modified": last_modified.replace(microsecond=0) if last_modified else None}
+    variant = {"etag": hashlib.sha1(key.encode("utf-8")).hexdigest(), "weak": True}
+    if is_not_modified(page, variant, request):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="text/html")
+
+    response.set_etag(variant["etag"], weak=True)
+    response.last_modified = page["last_modified"]
+    response.headers["Cache-Control"] = "public, no-cache"
+    return response
+
+
+def get_response(page, request):
+    encoding = get_encoding(page, request)
+    variant = page[encoding]
+
+    if is_not_modified(page, variant, request):
+        response = Response(status=304)
+    else:
+        response = Response(variant["body"], mimetype="text/html")
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+
+    response.set_etag(variant["etag"])
+    response.last_modified = page["last_modified"]
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "public, no-cache"
+    return response
@@ -0,0 +1,98 @@
+import re
+import threading
+import time
+
+import pandas as pd
+from sqlalchemy import MetaData, Table, inspect, text
+
+from bulk import write_frame
+
+
+class Generation:
+    # one rebuild of the tables: fresh rows go into <table>_g<id> copies of the live tables, publish() renames
+    # them over the live ones, so a reader sees either the previous or the new data. nothing is committed before
+    # publish(): the staged rows, the renames and other changes of the refresh (new underlyings, editions)
+    # go out in one commit or are discarded together
+    def __init__(self, session, models, generation_id=None):
+        self.session = session
+        self.id = generation_id or int(time.time())
+        self.metadata = MetaData()
+        self.tables = {model: Table("{}_g{}".format(model.__table__.name, self.id), self.metadata,
+                                    *[column.copy() for column in model.__table__.columns])
+                       for model in models}
+        self.staged = []
+        # editions of the staged data, set by publish together with the swap
+        self.editions = {}
+
+    def stage(self, model, df):
+        # the staging table is created only for a model which gets new rows
+        table = self.tables[model]
+        connection = self.session.connection()
+        table.drop(connection, checkfirst=True)
+        table.create(connection)
+        stats = write_frame(self.session, table, df)
+        self.staged.append(model)
+        return stats
+
+    def get_table(self, model):
+        # the table of this generation, the live one for a model which is not staged
+        return self.tables[model] if model in self.staged else model.__table__
+
+    def read(self, model):
+        # through the connection of the session, the staged rows are not committed yet
+        return pd.read_sql(self.get_table(model).select(), self.session.connection())
+
+    def quote(self, name):
+        return self.session.bind.dialect.identifier_preparer.quote(name)
+
+    def validate(self, min_ratio=0.5):
+        # the 50% sanity check of the refresh, Out: staged models holding too few rows against the live ones
+        invalid = []
+        for model in self.staged:
+            new_rows = self.session.execute(text("SELECT count(*) FROM {}".format(
+                self.quote(self.tables[model].name)))).scalar()
+            if new_rows <= min_ratio * self.session.query(model).count():
+                invalid.append(model)
+        return invalid
+
+    def publish(self, before_swap=None):
+        # all staged tables or nothing; before_swap - changes of the same transaction, e.g. editions.
+        # it goes first: its UPDATE opens the transaction on sqlite too, where ALTER alone would not
+        if before_swap is not None:
+            before_swap()
+            self.session.flush()
+        for model in self.staged:
+            name = model.__table__.name
+            self.session.execute(text("ALTER TABLE {} RENAME TO {}".format(
+                self.quote(name), self.quote("{}_r{}".format(name, self.id)))))
+            self.session.execute(text("ALTER TABLE {} RENAME TO {}".format(
+                self.quote(self.tables[model].name), self.quote(name))))
+        self.session.commit()
+
+    def discard(self):
+        # a rejected generation, its staging tables left on sqlite are taken by collect_garbage
+        self.session.rollback()
+
+
+def get_garbage(engine, models, generation_id):
+    # retired tables and staging tables left behind by rejected or failed rebuilds, up to this generation;
+    # the next rebuild has a greater id, so its staging tables are never taken
+    names = "|".join(re.escape(model.__table__.name) for model in models)
+    pattern = re.compile(r"^(?:{})_[rg](\d+)$".format(names))
+    return [name for name in inspect(engine).get_table_names()
+            if pattern.match(name) and int(pattern.match(name).group(1)) <= generation_id]
+
+
+def drop_tables(engine, names):
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for name in names:
+            connection.execute(text("DROP TABLE IF EXISTS {}".format(preparer.quote(name))))
+
+
+def collect_garbage(engine, models, generation_id):
+    # a DROP waits until readers of the old table are done, so it is not a part of the refresh
+    thread = threading.Thread(target=lambda: drop_tables(engine, get_garbage(engine, models, generation_id)),
+                              name="shadow-gc", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,79 @@
+import hashlib
+import os
+import shutil
+import threading
+
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+# optional directory for the parquet copy of the snapshot, shared by all workers of the host
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "")
+FRAMES = ["futures", "options", "underlyings", "cells", "ranks", "editions"]
+
+
+class SnapshotCache:
+    # per-process cache of the data derived from the tables, rebuilt only when the data version changes
+    def __init__(self, build, snapshot_dir=SNAPSHOT_DIR):
+        self.build = build
+        self.snapshot_dir = snapshot_dir if pyarrow is not None else ""
+        self.lock = threading.Lock()
+        self.version = None
+        self.snapshot = None
+
+    def get(self, version, read_frames):
+        # In: version string and a function returning {"futures": df, ...} from the database
+        if version == self.version:
+            return self.snapshot
+
+        with self.lock:
+            if version != self.version:
+                frames = self.load(version)
+                if frames is None:
+                    frames = read_frames()
+                    self.save(version, frames)
+                snapshot = self.build(frames)
+                snapshot["version"] = version
+                self.snapshot = snapshot
+                self.version = version
+        return self.snapshot
+
+    def clear(self):
+        with self.lock:
+            self.version = None
+            self.snapshot = None
+
+    def get_path(self, version):
+        return os.path.join(self.snapshot_dir, hashlib.md5(version.encode()).hexdigest())
+
+    def load(self, version):
+        path = self.get_path(version) if self.snapshot_dir else ""
+        if not path or not all(os.path.exists(os.path.join(path, name + ".parquet")) for name in FRAMES):
+            return None
+        return {name: pd.read_parquet(os.path.join(path, name + ".parquet"), memory_map=True) for name in FRAMES}
+
+    def save(self, version, frames):
+        if not self.snapshot_dir:
+            return
+        path = self.get_path(version)
+        if os.path.isdir(path):
+            return
+
+        # other workers must never see a half-written snapshot, so it appears by one rename
+        path_tmp = "{}.{}.tmp".format(path, os.getpid())
+        os.makedirs(path_tmp, exist_ok=True)
+        for name in FRAMES:
+            frames[name].to_parquet(os.path.join(path_tmp, name + ".parquet"))
+        try:
+            os.rename(path_tmp, path)
+        except OSError:
+            shutil.rmtree(path_tmp, ignore_errors=True)
+
+        for name in os.listdir(self.snapshot_dir):
+            old_path = os.path.join(self.snapshot_dir, name)
+            if old_path != path and not name.endswith(".tmp"):
+                shutil.rmtree(old_path, ignore_errors=True)
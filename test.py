@@ -0,0 +1,644 @@
+import asyncio
+import gzip
+import logging
+import sqlite3
+from datetime import date, datetime
+
+import aiohttp
+import numpy as np
+import pandas as pd
+import pytest
+from aiohttp import web
+from flask import Flask, request
+from sqlalchemy import Column, DateTime, Float, Integer, String, create_engine, event, inspect
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+import aggregate
+import bot
+import bulk
+import chain
+import iss
+import metrics
+from benchmark import COLUMNS_ISS, fill_database, make_iss_payload, measure, start_iss_server
+from page_cache import PageCache, get_response, get_stream_response
+from shadow import Generation, collect_garbage
+from functions import get_colors_vec, get_option_parts_vec, get_option_series_name, get_option_series_name_vec, \
+    get_option_underlying, get_option_underlying_vec, get_year_month, get_year_month_vec, round_up_log, \
+    round_up_log_vec, short_number, short_number_vec
+
+
+Base = declarative_base()
+
+
+class Instrument(Base):
+    __tablename__ = "instrument"
+    id = Column(Integer, primary_key=True)
+    secid = Column(String)
+    oi_rub = Column(Float)
+    date_created = Column(DateTime)
+
+
+class Square(Base):
+    # keyed by two columns as Cell
+    __tablename__ = "square"
+    id = Column(Integer, primary_key=True)
+    underlying = Column(String)
+    year_month = Column(String)
+    color = Column(String)
+    label = Column(String)
+    date_created = Column(DateTime)
+
+
+class Version(Base):
+    # changes of a refresh besides the staged tables, as the editions and the new underlyings
+    __tablename__ = "version"
+    id = Column(Integer, primary_key=True)
+    table = Column(String)
+    edition = Column(Integer)
+
+
+# bytes per 10k stored futures and options: the Future / Option / Cell frames a worker keeps in its snapshot
+# (about 2.6 MB, 5 MB without compact_frame) and the peak of update_matrix
+MEMORY_BUDGET = {"frames": 3 * 2 ** 20, "update_matrix": 12 * 2 ** 20}
+# option names of the synthetic ISS answer and the odd ones of the real ISS, the last one is not an option
+EXTRA_NAMES = ["RTS-6.21M170621CA150000", "Si-9.20M170920PA73.5", "BR-1.21M251220CA-5", "GAZR"]
+
+
+@pytest.fixture(scope="module")
+def payload():
+    return make_iss_payload()
+
+
+@pytest.fixture(scope="module")
+def database(payload, tmp_path_factory):
+    # a sqlite database filled by the refresh stages, Out: the app module, used inside its app context
+    import app as application
+
+    path = tmp_path_factory.mktemp("database")
+    chain_dir, chain.CHAIN_DIR = chain.CHAIN_DIR, str(path / "chains")
+    with application.app.app_context():
+        fill_database(application, payload, "sqlite:///{}".format(path / "test.db"))
+        yield application
+        application.db.session.remove()
+    chain.CHAIN_DIR = chain_dir
+
+
+@pytest.fixture(scope="module")
+def names(payload):
+    return pd.Series([row[1] for row in payload["options"]] + EXTRA_NAMES)
+
+
+@pytest.fixture(scope="module")
+def dates(payload):
+    return pd.Series(pd.to_datetime([row[2] for row in payload["futures"]]))
+
+
+@pytest.fixture(scope="module")
+def numbers():
+    return np.concatenate([[0, 1, 9.99, 10, 10.5, 99.95, 999, 1000, 1049, 1050, 9950, 9999, 10000, 999999,
+                            2.5e9, 999999999999, np.nan],
+                           np.random.RandomState(1).uniform(0, 1e11, 10000),
+                           np.random.RandomState(2).randint(0, 100000, 10000)])
+
+
+# the vectorized transforms must give exactly what the per-row functions give
+def test_get_option_underlying(names):
+    assert (get_option_underlying_vec(names) == names.apply(get_option_underlying)).all()
+
+
+def test_get_option_series_name(names):
+    assert (get_option_series_name_vec(names) == names.apply(get_option_series_name)).all()
+
+
+def test_get_year_month(dates):
+    assert (get_year_month_vec(dates) == dates.apply(get_year_month)).all()
+    periods = pd.period_range(dates.min(), dates.max(), freq="M")
+    assert list(get_year_month_vec(periods)) == [get_year_month(p) for p in periods]
+
+
+def test_round_up_log(numbers):
+    numbers = np.nan_to_num(numbers)
+    base = numbers.max()
+    assert list(round_up_log_vec(numbers, base, 6)) == [round_up_log(number, base, 6) for number in numbers]
+
+
+def test_short_number(numbers):
+    assert short_number_vec(numbers) == [short_number(number) for number in numbers]
+
+
+def test_get_option_parts(names):
+    parts = get_option_parts_vec(names)
+    assert (parts["UNDERLYING"][:-1] == names.apply(get_option_underlying)[:-1]).all()
+    assert (parts["SERIES"][:-1] == names.apply(get_option_series_name)[:-1]).all()
+    assert list(parts["STRIKE"][-4:-1]) == [150000, 73.5, -5]
+    assert parts.iloc[-1].isnull().all()
+
+
+def run_bot(handlers, run, subscriptions_file, get_digest=lambda day, underlyings: [], timeout=10):
+    # run(bot) against a local stand-in of api.telegram.org, handlers: {"sendMessage": async handler, ...}
+    async def main():
+        application = web.Application()
+        for method, handler in handlers.items():
+            application.router.add_post("/botTOKEN/" + method, handler)
+        runner = web.AppRunner(application)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        b = bot.Bot("http://127.0.0.1:{}".format(runner.addresses[0][1]), "TOKEN", str(subscriptions_file),
+                    get_digest)
+        b.rate_limiter = bot.RateLimiter(bot.RATE_LIMIT)
+        try:
+            async with aiohttp.ClientSession() as b.session:
+                return await asyncio.wait_for(run(b), timeout)
+        finally:
+            await runner.cleanup()
+    return asyncio.run(main())
+
+
+def test_bot_commands_and_digests(tmp_path):
+    updates = [{"update_id": 1, "message": {"chat": {"id": 10}, "text": "/subscribe Si BR"}},
+               {"update_id": 2, "message": {"chat": {"id": 11}, "text": "/subscribe all"}},
+               {"update_id": 3, "message": {"chat": {"id": 12}, "text": "/today 2020-09-17"}},
+               {"update_id": 4, "message": {"chat": {"id": 13}, "text": "/subscribe BR Si"}}]
+    offsets = []
+    sent = []
+    digests = []
+
+    async def get_updates(request):
+        params = await request.json()
+        offsets.append(params["offset"])
+        return web.json_response({"ok": True, "result": [u for u in updates if params["offset"] is None or
+                                                         u["update_id"] >= params["offset"]]})
+
+    async def send_message(request):
+        params = await request.json()
+        sent.append(params["chat_id"])
+        return web.json_response({"ok": True, "result": {}})
+
+    def get_digest(day, underlyings):
+        digests.append((day, tuple(underlyings)))
+        return ["digest"]
+
+    async def run(b):
+        poll = asyncio.ensure_future(b.poll())
+        while len(sent) < len(updates):
+            await asyncio.sleep(0.05)
+        poll.cancel()
+        digests.clear()
+        return await b.send_digests(date(2020, 9, 17))
+
+    sends = run_bot({"getUpdates": get_updates, "sendMessage": send_message}, run, tmp_path / "subscriptions.json", get_digest)
+
+    assert offsets[:2] == [None, 5]
+    subscriptions = bot.load_subscriptions(str(tmp_path / "subscriptions.json"))
+    assert subscriptions == {10: ["BR", "Si"], 11: [], 13: ["BR", "Si"]}
+    # one digest per distinct set of underlyings, sent to every chat of the set
+    assert sorted(digests) == [(date(2020, 9, 17), ()), (date(2020, 9, 17), ("BR", "Si"))]
+    assert sends == 3
+
+
+def test_bot_retries_are_bounded(tmp_path):
+    calls = []
+
+    async def send_message(request):
+        calls.append(1)
+        return web.json_response({"ok": False, "error_code": 429, "parameters": {"retry_after": 0}}, status=429)
+
+    async def run(b):
+        return await b.request("sendMessage", chat_id=1, text="x")
+
+    data = run_bot({"sendMessage": send_message}, run, tmp_path / "subscriptions.json")
+    assert not data["ok"]
+    assert len(calls) == bot.MAX_RETRIES + 1
+
+
+def test_bot_logs_failed_chat_tasks(tmp_path, caplog):
+    async def send_message(request):
+        return web.Response(status=502, text="Bad Gateway")
+
+    async def run(b):
+        task = b.start_task(b.handle(1, "/list"))
+        await asyncio.wait([task])
+        await asyncio.sleep(0)
+        return b.tasks
+
+    with caplog.at_level(logging.ERROR, logger="bot"):
+        tasks = run_bot({"sendMessage": send_message}, run, tmp_path / "subscriptions.json")
+    assert not tasks
+    assert [record.exc_info[0] for record in caplog.records] == [aiohttp.ContentTypeError]
+
+
+def test_bot_digest_worker_survives_failed_digests(tmp_path, caplog):
+    # a database error of get_digest is logged and the next digest is still tried
+    calls = []
+
+    def get_digest(day, underlyings):
+        calls.append(day)
+        raise RuntimeError("database is locked")
+
+    async def run(b):
+        b.subscriptions = {10: []}
+        b.get_next_digest = lambda now: now
+        worker = asyncio.ensure_future(b.digest_worker())
+        while len(calls) < 2:
+            await asyncio.sleep(0.01)
+        worker.cancel()
+        return worker
+
+    with caplog.at_level(logging.ERROR, logger="bot"):
+        worker = run_bot({}, run, tmp_path / "subscriptions.json", get_digest)
+    assert worker.cancelled()
+    assert {record.exc_info[0] for record in caplog.records} == {RuntimeError}
+
+
+def test_memory_budget(database):
+    stages = {}
+    measure(stages, "update_matrix", database.update_matrix)
+    frames = database.read_frames()
+    used = {"frames": sum(frames[name].memory_usage(deep=True).sum() for name in ["futures", "options", "cells"]),
+            "update_matrix": stages["update_matrix"]["peak_mb"] * 2 ** 20}
+    rows = len(frames["futures"]) + len(frames["options"])
+    for name, budget in MEMORY_BUDGET.items():
+        assert used[name] * 10000 / rows <= budget, name
+
+
+def get_strikes(rows):
+    # get_data()["strikes"] of the rows (optiontype, strike, prevopenposition) of one Si series
+    return pd.DataFrame([{"SECID": "Si{}{}".format(option_type, strike), "SERIES": "Si-9.20M170920",
+                          "LASTTRADEDATE": "2020-09-17", "ASSETCODE": "Si", "UNDERLYING": "Si-9.20",
+                          "OPTIONTYPE": option_type, "STRIKE": strike, "PREVOPENPOSITION": oi, "OI_RUB": oi * 1000.0}
+                         for option_type, strike, oi in rows])
+
+
+def test_chain_of_calls_only():
+    index = chain.ChainIndex(chain.get_chain_frame(get_strikes([("C", 70000, 10), ("C", 72500, 20), ("C", 75000, 30)])))
+    d = index.get_chain("Si-9.20M170920")
+    assert [(s["strike"], s["call_oi"], s["put_oi"], s["put_oi_rub"]) for s in d["strikes"]] == \
+        [(70000, 10, 0, 0), (72500, 20, 0, 0), (75000, 30, 0, 0)]
+    assert (d["call_oi"], d["put_oi"], d["put_call_ratio"]) == (60, 0, 0)
+
+
+def test_chain_of_puts_only():
+    index = chain.ChainIndex(chain.get_chain_frame(get_strikes([("P", 70000, 10), ("P", 72500, 20)])))
+    d = index.get_chain("Si-9.20M170920")
+    assert [(s["strike"], s["call_oi"], s["put_oi"]) for s in d["strikes"]] == [(70000, 0, 10), (72500, 0, 20)]
+    assert (d["call_oi"], d["put_oi"], d["put_call_ratio"]) == (0, 30, None)
+    assert index.get_chain("Si-12.20M171220") is None
+
+
+def pandas_cells(df_fut, df_opt):
+    # the pandas aggregation update_matrix used to do, the baseline of the database aggregation
+    df_futopt_grouped = pd.concat([df_fut.assign(type='F'), df_opt.assign(type='O')]).astype(
+        {"lasttrademonth": object, "assetcode": object}).groupby(["lasttrademonth", "assetcode"])
+    df_cells = df_futopt_grouped['oi_rub'].sum().reset_index()\
+        .rename(columns={"assetcode": "underlying", "lasttrademonth": "year_month"})
+    df_cells["color"] = get_colors_vec(df_cells['oi_rub'], df_cells['oi_rub'].max())
+    df_cells["label"] = [" ".join(sorted(cell_type)) for cell_type in df_futopt_grouped['type'].unique()]
+    ranks = df_fut.astype({"assetcode": object}).groupby('assetcode')['oi_rub'].sum().sort_values(ascending=False)
+    return df_cells, list(ranks.index)
+
+
+@pytest.mark.skipif(sqlite3.sqlite_version_info < (3, 25), reason="window functions need sqlite 3.25")
+def test_aggregation_matches_pandas(database):
+    database.update_matrix()
+    df_cells, lst_ranks = pandas_cells(database.read_table(database.Future), database.read_table(database.Option))
+
+    connection = database.db.session.connection()
+    future, option = database.Future.__table__, database.Option.__table__
+    df_sql = df_cells.merge(aggregate.get_cells(connection, future, option), on=["underlying", "year_month"],
+                            how="outer", suffixes=("", "_db"), indicator=True)
+    assert (df_sql["_merge"] == "both").all()
+    assert np.isclose(df_sql["oi_rub"], df_sql["oi_rub_db"], rtol=1e-9).all()
+
+    df_stored = df_cells.merge(database.read_table(database.Cell).astype(object), on=["underlying", "year_month"],
+                               how="outer", suffixes=("", "_db"), indicator=True)
+    assert (df_stored["_merge"] == "both").all()
+    assert (df_stored["color"] == df_stored["color_db"]).all()
+    assert (df_stored["label"] == df_stored["label_db"]).all()
+
+    assert list(aggregate.get_ranks(connection, future, option)["underlying"]) == lst_ranks
+
+
+class FailingClient:
+    # ISS announces a new edition, but the download of the securities fails
+    def get_all_editions(self):
+        return {"futures": 2, "options": 2}
+
+    def get_all_securities(self, columns, paginate=False):
+        raise IOError("ISS is not available")
+
+
+@pytest.mark.parametrize("mode", ["incremental", "full"])
+def test_failed_download_publishes_nothing(database, monkeypatch, mode):
+    monkeypatch.setattr(database, "REFRESH_MODE", mode)
+    monkeypatch.setattr(iss, "client", FailingClient())
+    monkeypatch.setitem(database.iss_editions_cache, "checked_at", 0.0)
+    database.db.session.rollback()
+    version = database.get_data_version()
+    tables = inspect(database.db.engine).get_table_names()
+
+    with pytest.raises(IOError):
+        database.refresh_data()
+    database.db.session.rollback()
+    assert database.get_data_version() == version
+    assert inspect(database.db.engine).get_table_names() == tables
+
+
+@pytest.fixture
+def iss_server(payload):
+    # In: start_iss_server options, Out: an IssClient of the started stand-in
+    servers = []
+
+    def start(**kwargs):
+        server, base_url = start_iss_server(payload, edition=7, **kwargs)
+        servers.append(server)
+        return iss.IssClient(base_url, retries=0)
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+# 360 futures fit in the first page, 9600 options are 20 full pages and an empty one
+@pytest.mark.parametrize("cursor", [True, False])
+def test_iss_pagination(payload, iss_server, cursor):
+    securities = iss_server(page_size=480, cursor=cursor).get_all_securities(COLUMNS_ISS, paginate=True)
+    for market in ["futures", "options"]:
+        assert securities[market]["frame"].values.tolist() == payload[market]
+        assert securities[market]["edition"] == 7
+
+
+def test_iss_pagination_ignored_start(iss_server, monkeypatch):
+    monkeypatch.setattr(iss, "MAX_PAGES", 5)
+    with pytest.raises(RuntimeError):
+        iss_server(page_size=480, ignore_start=True).get_all_securities(COLUMNS_ISS, paginate=True)
+
+
+def test_iss_editions(iss_server):
+    assert iss_server().get_all_editions() == {"futures": 7, "options": 7}
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def get_rows(session, model, columns):
+    return sorted(session.query(*[getattr(model, column) for column in columns]).all())
+
+
+def test_upsert_frame(session):
+    bulk.write_frame(session, Instrument, pd.DataFrame({"secid": ["A", "B", "C"], "oi_rub": [1.0, 2.0, 3.0]}))
+
+    # B changed, C unchanged, D new, A gone
+    df = pd.DataFrame({"secid": ["B", "C", "D"], "oi_rub": [20.0, 3.0, 4.0]})
+    stats = bulk.upsert_frame(session, Instrument, df, ["secid"], ["oi_rub"])
+    session.commit()
+    assert [stats[key] for key in ["inserted", "updated", "deleted", "unchanged", "rows"]] == [1, 1, 1, 1, 3]
+    assert get_rows(session, Instrument, ["secid", "oi_rub"]) == [("B", 20.0), ("C", 3.0), ("D", 4.0)]
+
+
+def test_upsert_frame_composite_keys(session):
+    keys = ["underlying", "year_month"]
+    bulk.write_frame(session, Square, pd.DataFrame([["Si", "2020 Sep", "#f8f9fa", "F"],
+                                                    ["Si", "2020 Dec", "#e9ecef", "F O"],
+                                                    ["Eu", "2020 Sep", "#dee2e6", "F"]], columns=keys + ["color", "label"]))
+
+    # (Si, 2020 Dec) changed its label, (Eu, 2020 Sep) unchanged, (Eu, 2020 Dec) new, (Si, 2020 Sep) gone -
+    # the delete must not take (Eu, 2020 Sep) or (Si, 2020 Dec) sharing one of its key values
+    stats = bulk.upsert_frame(session, Square, pd.DataFrame([["Si", "2020 Dec", "#e9ecef", "F"],
+                                                             ["Eu", "2020 Sep", "#dee2e6", "F"],
+                                                             ["Eu", "2020 Dec", "#ced4da", "O"]],
+                                                            columns=keys + ["color", "label"]),
+                              keys, ["color", "label"])
+    session.commit()
+    assert [stats[key] for key in ["inserted", "updated", "deleted", "unchanged"]] == [1, 1, 1, 1]
+    assert get_rows(session, Square, keys + ["color", "label"]) == [("Eu", "2020 Dec", "#ced4da", "O"),
+                                                                    ("Eu", "2020 Sep", "#dee2e6", "F"),
+                                                                    ("Si", "2020 Dec", "#e9ecef", "F")]
+
+
+@pytest.fixture
+def live_session(tmp_path):
+    # a sqlite file, the garbage collector and readers use connections of their own; 4 live instruments, 2 squares
+    engine = create_engine("sqlite:///{}".format(tmp_path / "live.db"))
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    bulk.write_frame(session, Instrument, pd.DataFrame({"secid": list("ABCD"), "oi_rub": [1.0, 2.0, 3.0, 4.0]}))
+    bulk.write_frame(session, Square, pd.DataFrame({"underlying": ["Si", "Eu"], "year_month": ["2020 Sep"] * 2}))
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def read_secids(engine):
+    return sorted(pd.read_sql("SELECT secid FROM instrument", engine)["secid"])
+
+
+def test_generation_rejected(live_session):
+    session = live_session
+    engine = session.bind
+    # the refresh flushed its changes before the tables are staged
+    session.add(Version(table="instrument", edition=2))
+    session.flush()
+    generation = Generation(session, [Instrument, Square], 1)
+    generation.stage(Instrument, pd.DataFrame({"secid": ["E", "F"], "oi_rub": [5.0, 6.0]}))
+    generation.stage(Square, pd.DataFrame({"underlying": ["Si", "Eu"], "year_month": ["2020 Dec"] * 2}))
+
+    # 2 staged instruments of 4 live ones are not more than 50%, 2 squares of 2 are
+    assert generation.validate() == [Instrument]
+    generation.discard()
+    collect_garbage(engine, [Instrument, Square], generation.id).join()
+    assert read_secids(engine) == list("ABCD")
+    assert get_rows(session, Square, ["year_month"]) == [("2020 Sep",)] * 2
+    assert session.query(Version).count() == 0
+    assert sorted(inspect(engine).get_table_names()) == ["instrument", "square", "version"]
+
+
+def test_generation_publish(live_session):
+    session = live_session
+    engine = session.bind
+    commits = []
+    event.listen(session, "after_commit", lambda s: commits.append(s))
+    generation = Generation(session, [Instrument, Square], 1)
+    generation.stage(Instrument, pd.DataFrame({"secid": list("CDEF"), "oi_rub": [3.0, 4.0, 5.0, 6.0]}))
+    generation.stage(Square, pd.DataFrame({"underlying": ["Si", "Eu"], "year_month": ["2020 Dec"] * 2}))
+    assert generation.validate() == []
+    assert generation.read(Instrument)["secid"].tolist() == list("CDEF")
+
+    # nothing is committed by the stages, readers keep the live tables
+    assert not commits
+    assert read_secids(engine) == list("ABCD")
+    # pysqlite commits a CREATE which opens no transaction, but not the rows
+    assert pd.read_sql("SELECT count(*) AS n FROM instrument_g1", engine)["n"].tolist() == [0]
+
+    generation.publish(lambda: session.add(Version(table="instrument", edition=2)))
+    assert len(commits) == 1
+    assert read_secids(engine) == list("CDEF")
+    assert pd.read_sql("SELECT year_month FROM square", engine)["year_month"].tolist() == ["2020 Dec"] * 2
+    assert pd.read_sql("SELECT edition FROM version", engine)["edition"].tolist() == [2]
+    assert sorted(inspect(engine).get_table_names()) == ["instrument", "instrument_r1", "square", "square_r1",
+                                                         "version"]
+
+    # the previous tables are dropped afterwards
+    collect_garbage(engine, [Instrument, Square], generation.id).join()
+    assert sorted(inspect(engine).get_table_names()) == ["instrument", "square", "version"]
+
+
+@pytest.fixture
+def page_client():
+    # Out: a test client of /page/<name> from a PageCache of 2 pages and of /stream/<name>, state["version"] is
+    # the data version, state["renders"] counts the renders
+    flask_app = Flask("page_cache_test")
+    cache = PageCache(max_pages=2)
+    state = {"version": 1, "renders": 0}
+    last_modified = datetime(2020, 9, 17, 10, 0, 0, 500)
+
+    @flask_app.route("/page/<name>")
+    def page(name):
+        def render():
+            state["renders"] += 1
+            return "<p>{} {}</p>".format(name, state["version"])
+        return get_response(cache.get(state["version"], name, render, last_modified), request)
+
+    @flask_app.route("/stream/<name>")
+    def stream(name):
+        return get_stream_response(iter(["<p>", name, "</p>"]), "{}|{}".format(state["version"], name),
+                                   last_modified, request)
+
+    return flask_app.test_client(), state
+
+
+def test_page_etag_per_encoding(page_client):
+    client, state = page_client
+    r = client.get("/page/index", headers={"Accept-Encoding": "gzip"})
+    assert r.headers["Content-Encoding"] == "gzip" and gzip.decompress(r.data) == b"<p>index 1</p>"
+    etag = r.headers["ETag"]
+
+    r = client.get("/page/index", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert (r.status_code, r.data, r.headers["ETag"]) == (304, b"", etag)
+    # the gzip etag does not match the identity body
+    r = client.get("/page/index", headers={"If-None-Match": etag})
+    assert (r.status_code, r.data) == (200, b"<p>index 1</p>")
+    assert client.get("/page/index", headers={"If-None-Match": r.headers["ETag"]}).status_code == 304
+    assert state["renders"] == 1
+
+
+def test_page_if_modified_since(page_client):
+    client, state = page_client
+    last_modified = client.get("/page/index").headers["Last-Modified"]
+    assert last_modified == "Thu, 17 Sep 2020 10:00:00 GMT"
+    assert client.get("/page/index", headers={"If-Modified-Since": last_modified}).status_code == 304
+    assert client.get("/page/index", headers={"If-Modified-Since": "Wed, 16 Sep 2020 10:00:00 GMT"}).status_code == 200
+
+
+def test_stream_weak_etag(page_client):
+    client, state = page_client
+    r = client.get("/stream/index")
+    assert r.headers["ETag"].startswith("W/") and r.data == b"<p>index</p>"
+    etag = r.headers["ETag"]
+    r = client.get("/stream/index", headers={"If-None-Match": etag})
+    assert (r.status_code, r.data) == (304, b"")
+
+    state["version"] = 2
+    r = client.get("/stream/index", headers={"If-None-Match": etag})
+    assert r.status_code == 200 and r.headers["ETag"] != etag
+
+
+def test_page_cache_eviction(page_client):
+    client, state = page_client
+    etag = client.get("/page/index").headers["ETag"]
+    client.get("/page/index")
+    assert state["renders"] == 1
+
+    # a new data version drops the stored pages and the etags of the previous one
+    state["version"] = 2
+    r = client.get("/page/index", headers={"If-None-Match": etag})
+    assert (r.status_code, r.data, state["renders"]) == (200, b"<p>index 2</p>", 2)
+
+    # above max_pages the least recently used page goes first
+    client.get("/page/a")
+    client.get("/page/b")
+    client.get("/page/a")
+    assert state["renders"] == 4
+    client.get("/page/index")
+    assert state["renders"] == 5
+
+
+def get_counter(name, **labels):
+    return metrics.counters.get(metrics.get_key(name, labels), 0)
+
+
+def test_request_metrics(database):
+    client = database.app.test_client()
+    database.snapshot_cache.clear()
+
+    counts = [get_counter("api_requests_total", route="matrix", snapshot="build"),
+              get_counter("api_requests_total", route="matrix", snapshot="hit")]
+    assert [client.get("/api/matrix").status_code for i in range(3)] == [200] * 3
+    assert [get_counter("api_requests_total", route="matrix", snapshot="build"),
+            get_counter("api_requests_total", route="matrix", snapshot="hit")] == [counts[0] + 1, counts[1] + 2]
+
+    counts = [get_counter("page_requests_total", page="index_lazy", cache="miss"),
+              get_counter("page_requests_total", page="index_lazy", cache="hit")]
+    assert [client.get("/lazy?underlying=U1,U2").status_code for i in range(3)] == [200] * 3
+    assert [get_counter("page_requests_total", page="index_lazy", cache="miss"),
+            get_counter("page_requests_total", page="index_lazy", cache="hit")] == [counts[0] + 1, counts[1] + 2]
+
+
+@pytest.fixture
+def client(database):
+    # a test client of the app with the matrix of the payload published
+    if database.get_snapshot()["frames"]["cells"].empty:
+        database.update_matrix()
+        database.db.session.commit()
+    return database.app.test_client()
+
+
+def get_cells(d):
+    return {(underlying, month) for underlying, months in d["cells"].items() for month in months}
+
+
+def test_filters_bad_value(client):
+    for query in ["start=bad", "end=2020-13", "min_oi=many"]:
+        assert client.get("/api/matrix?" + query).status_code == 400
+        assert client.get("/?" + query).status_code == 400
+
+
+def test_filters_section_underlying_months(client):
+    d = client.get("/api/matrix").get_json()
+    section = d["sections"]["Валюта"]
+
+    filtered = client.get("/api/matrix?section=Валюта").get_json()
+    assert filtered["sections"] == {"Валюта": section}
+    assert get_cells(filtered) == {cell for cell in get_cells(d) if cell[0] in section}
+
+    filtered = client.get("/api/matrix?underlying={},U1&start=2020-10&end=2020-12".format(section[0])).get_json()
+    assert filtered["months"] == ["2020 Oct", "2020 Nov", "2020 Dec"]
+    assert get_cells(filtered) == {cell for cell in get_cells(d)
+                                   if cell[0] in [section[0], "U1"] and cell[1] in filtered["months"]}
+    # an underlying of another section gives nothing
+    assert not client.get("/api/matrix?section=Валюта&underlying=U1").get_json()["cells"]
+
+
+def test_filters_min_oi(client, database):
+    # the futures and the options frames have categories of their own (options are on the nearest 4 months only),
+    # the OI of a cell is the sum of both
+    frames = database.get_snapshot()["frames"]
+    df = pd.concat([frames[name][["assetcode", "lasttrademonth", "oi_rub"]].astype({"assetcode": str,
+                                                                                   "lasttrademonth": str})
+                    for name in ["futures", "options"]])
+    df_oi = df.groupby(["assetcode", "lasttrademonth"])["oi_rub"].sum()
+    min_oi = df_oi.median()
+
+    d = client.get("/api/matrix").get_json()
+    filtered = client.get("/api/matrix?min_oi={!r}".format(min_oi)).get_json()
+    expected = {cell for cell in get_cells(d) if df_oi.get(cell, 0) >= min_oi}
+    assert 0 < len(expected) < len(get_cells(d))
+    assert get_cells(filtered) == expected
+    assert filtered["cells"] == {u: {m: d["cells"][u][m] for m in months} for u, months in filtered["cells"].items()}